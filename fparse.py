@@ -1,54 +1,344 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
 import subprocess
 import sys
+import os
+import mmap
 import re
+import string
+import time
+import hashlib
+import multiprocessing
 from os import path
-from pprint import pprint
+from copy import deepcopy
+from ast import literal_eval
 from itertools import chain
+from optparse import OptionParser
+from collections import OrderedDict
+from bisect import bisect
+
+try:
+    from StringIO import StringIO # Python 2, print() writes str there
+except ImportError:
+    from io import StringIO
+
+# macros defined when preprocessing
+DEFAULT_DEFINES = ("__parallel",)
 
 #===============================================================================
 def main():
-    if(len(sys.argv) != 3):
-        print("Usage: fparse.py <input.F> <output.ast>")
+    parser = OptionParser(usage="fparse.py [options] <input.F|-> <output.ast>")
+    parser.add_option("--depfile", metavar="FILE",
+                      help="write a make/ninja dependency file listing every"
+                           " source file (included ones too) of the output")
+    parser.add_option("--callgraph", action="store_true", default=False,
+                      help="record the routines called by each routine")
+    parser.add_option("--incremental", action="store_true", default=False,
+                      help="record text spans and hashes, and reuse the unchanged"
+                           " parts of the existing output file")
+    parser.add_option("--locations", action="store_true", default=False,
+                      help="record where each module, type, routine, interface"
+                           " and variable is, in the source files and in the"
+                           " preprocessed text")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="number of processes parsing the routines of the module")
+    parser.add_option("--preprocessed", action="store_true", default=False,
+                      help="the input is already preprocessed (e.g. compiler -E"
+                           " output), do not run cpp over it")
+    options, args = parser.parse_args()
+    if(len(args) != 2):
+        parser.print_usage()
         sys.exit(1)
 
-    fn_in, fn_out = sys.argv[1:]
-    assert(fn_in.endswith(".F"))
+    fn_in, fn_out = args # "-" reads the input from stdin
     assert(fn_out.endswith(".ast"))
 
-    ast = parse_file(fn_in)
+    previous = None
+    if(options.incremental and path.exists(fn_out)):
+        f = open(fn_out)
+        previous = eval_ast(f.read())
+        f.close()
+        if(not 'header_hash' in previous):
+            previous = None # it was not parsed incrementally
+
+    deps = []
+    ast = parse_file(fn_in, deps, callgraph=options.callgraph, spans=options.incremental, previous=previous,
+                     jobs=options.jobs, preprocessed=options.preprocessed, locations=options.locations)
     f = open(fn_out, "w")
-    pprint(ast, stream=f)
+    f.write(format_ast(ast) + "\n")
     f.close()
 
-    print "Wrote: "+fn_out
+    print("Wrote: "+fn_out)
+
+    if(options.depfile):
+        write_depfile(options.depfile, fn_out, deps, fn_in)
+        print("Wrote: "+options.depfile)
+
+#===============================================================================
+def parse_file(fn, deps=None, callgraph=False, spans=False, previous=None, jobs=1, preprocessed=False,
+               locations=False):
+    """Parse the module contained in file fn, "-" being stdin.
+       If a deps list is given, it is extended with the names of the files
+       (fn itself and the included ones) the module was read from.
+       If callgraph is set, each routine gets the names it calls recorded
+       while its body is skipped over (cf. parse_routine()).
+       If preprocessed is set, fn is parsed as is: cpp is not run again, the
+       line markers it holds are still used for locus() and deps.
+       For spans, previous, jobs and locations see parse_module()."""
+    if(fn == "-" or preprocessed):
+        text = read_source(fn)
+        if(fn == "-"):
+            fn = "<stdin>"
+        if(not preprocessed):
+            text = preprocess(fn, text)
+        stream = InputStream(fn, text)
+    else:
+        stream = InputStream(fn)
+    if(deps is not None):
+        deps.extend(stream.dependencies())
+    return(parse_stream(stream, callgraph, spans, previous, jobs, locations))
 
 #===============================================================================
-def parse_file(fn):
-    stream = InputStream(fn)
+def parse_stream(stream, callgraph=False, spans=False, previous=None, jobs=1, locations=False):
     line = stream.peek_next_fortran_line()
     if(line.startswith("MODULE ")):
-        return parse_module(stream)
+        return parse_module(stream, callgraph, spans, previous, jobs, locations)
     else:
         raise ParserException(line, stream.locus())
 
     #TODO: ensure nothing comes after module
 
 #===============================================================================
-def parse_module(stream):
+class Parser(object):
+    """Reusable in-process parser.
+       It holds the configuration shared by many parse_*() calls:
+         defines:      macros defined when preprocessing
+         preprocessor: callable(filename, source, defines) returning the
+                       preprocessed text, source is None when the file has to
+                       be read from disk (default: preprocess(), i.e. cpp)
+         callgraph:    record the routines called by each routine
+         spans:        record the spans and hashes needed to parse again
+                       incrementally, cf. parse_module()
+         locations:    record where each node is, cf. parse_module()
+         jobs:         number of processes parsing the routines of a module
+         projection:   if given, only these keys of the module AST are returned
+         cache_size:   number of ASTs kept, keyed by the preprocessed text
+         hooks:        callables invoked as hook(filename, ast, stats) after
+                       each parse, stats is a dict of timings and sizes"""
+
+    def __init__(self, defines=DEFAULT_DEFINES, preprocessor=None, callgraph=False,
+                 spans=False, jobs=1, projection=None, cache_size=256, hooks=(), locations=False):
+        self.defines = tuple(defines)
+        self.preprocessor = preprocessor or preprocess
+        self.callgraph = callgraph
+        self.spans = spans
+        self.locations = locations
+        self.jobs = jobs
+        self.projection = projection
+        self.cache_size = cache_size
+        self.hooks = list(hooks)
+        self._cache = OrderedDict()
+
+    # For all the parse_*() methods: the AST of a previous parse of the same
+    #   file (with spans) can be given to parse it again incrementally.
+    #   The source or text can be given as bytes too (cf. to_text()).
+
+    def parse_file(self, filename, deps=None, previous=None):
+        """Preprocess and parse a file"""
+        return(self._parse(filename, None, True, deps, previous))
+
+    def parse_source(self, source, filename="<memory>", deps=None, previous=None):
+        """Preprocess and parse source code held in memory, filename is used
+           for the locus and to find the included files"""
+        return(self._parse(filename, source, True, deps, previous))
+
+    def parse_string(self, text, filename="<string>", deps=None, previous=None):
+        """Parse already preprocessed text"""
+        return(self._parse(filename, text, False, deps, previous))
+
+    def parse_preprocessed(self, filename, deps=None, previous=None):
+        """Parse an already preprocessed file (e.g. compiler -E output)"""
+        return(self._parse(filename, read_source(filename), False, deps, previous))
+
+    def _parse(self, filename, text, needs_cpp, deps, previous):
+        t0 = time.time()
+        if(text is not None):
+            text = to_text(text)
+        if(needs_cpp):
+            text = self.preprocessor(filename, text, self.defines)
+        t1 = time.time()
+        stream = InputStream(filename, buffer=text)
+        if(deps is not None):
+            deps.extend(stream.dependencies())
+
+        # the filename and locations are in the AST, even when not in the text
+        key = (filename, self.locations, hashlib.sha1(to_bytes(text)).hexdigest())
+        ast = self._cache.pop(key, None)
+        cached = ast is not None
+        if(not cached):
+            ast = parse_stream(stream, self.callgraph, self.spans, previous, self.jobs, self.locations)
+        if(self.cache_size):
+            self._cache[key] = ast  # most recently used ones go last
+            while(len(self._cache) > self.cache_size):
+                self._cache.popitem(last=False)
+        t2 = time.time()
+
+        if(self.projection):
+            ast = dict((k, ast[k]) for k in self.projection)
+        if(self.cache_size):
+            ast = deepcopy(ast)  # the cached one must not be changed by the caller
+        stats = {'preprocess_time':t1-t0, 'parse_time':t2-t1, 'buffer_size':len(text),
+                 'fortran_lines':stream.n_fortran_lines, 'cached':cached}
+        for hook in self.hooks:
+            hook(filename, ast, stats)
+        return(ast)
+
+#===============================================================================
+def format_ast(node, width=80):
+    """Return the text of an AST as pprint.pformat() lays it out on Python 2.
+       Later versions wrap long strings and pack containers differently, this
+       keeps the .ast files identical whatever the Python version."""
+    out = []
+    format_node(node, out, 0, 0, width)
+    return("".join(out))
+
+def format_node(node, out, indent, allowance, width):
+    text = repr_node(node)
+    if(len(text) <= width - 1 - indent - allowance or not isinstance(node, (dict, list, tuple)) or not node):
+        out.append(text)
+    elif(isinstance(node, dict)):
+        out.append("{")
+        for i, (k, v) in enumerate(sorted(node.items())):
+            key = repr_node(k)
+            out.append((",\n" + " "*(indent+1) if i else "") + key + ": ")
+            format_node(v, out, indent + 1 + len(key) + 2, allowance + 1, width)
+        out.append("}")
+    else:
+        out.append("[" if isinstance(node, list) else "(")
+        for i, v in enumerate(node):
+            out.append(",\n" + " "*(indent+1) if i else "")
+            format_node(v, out, indent + 1, allowance + 1, width)
+        out.append("]" if isinstance(node, list) else ("," if len(node) == 1 else "") + ")")
+
+def repr_node(node):
+    if(isinstance(node, dict)):
+        return("{%s}" % ", ".join("%s: %s" % (repr_node(k), repr_node(v)) for k, v in sorted(node.items())))
+    if(isinstance(node, list)):
+        return("[%s]" % ", ".join(repr_node(v) for v in node))
+    if(isinstance(node, tuple)):
+        return("(%s%s)" % (", ".join(repr_node(v) for v in node), "," if len(node) == 1 else ""))
+    if(isinstance(node, str) and str is not bytes):
+        return(repr(to_bytes(node))[1:]) # the escaped bytes, as on Python 2
+    return(repr(node))
+
+#===============================================================================
+def eval_ast(text):
+    """Return the AST (or index, ...) written by format_ast()"""
+    node = literal_eval(text)
+    if(str is not bytes and "\\x" in text):
+        node = decode_strings(node) # some bytes were written escaped
+    return(node)
+
+def decode_strings(node):
+    """On Python 3, turn the strings read back from escaped bytes (e.g.
+       '\\xc3\\xbc', read as latin-1 chars) into text again, cf. to_text()"""
+    if(isinstance(node, str)):
+        return(to_text(node.encode("latin-1")))
+    if(isinstance(node, dict)):
+        return(dict((decode_strings(k), decode_strings(v)) for k, v in node.items()))
+    if(isinstance(node, list)):
+        return([decode_strings(v) for v in node])
+    if(isinstance(node, tuple)):
+        return(tuple(decode_strings(v) for v in node))
+    return(node)
+
+#===============================================================================
+def write_depfile(fn_dep, target, deps, source=None):
+    """Write a make/ninja compatible dependency file for target.
+       An empty rule is added for each included file (as "cpp -MP" does),
+       i.e. for the dependencies but the source file (none for stdin), so
+       that make does not complain when a header gets removed."""
+    def escape(fn):
+        return(fn.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ "))
+    f = open(fn_dep, "w")
+    f.write("%s: %s\n" % (escape(target), " \\\n  ".join([escape(d) for d in deps])))
+    for d in deps:
+        if(d == source):
+            continue
+        f.write("\n%s:\n" % escape(d))
+    f.close()
+
+#===============================================================================
+def parse_module(stream, callgraph=False, spans=False, previous=None, jobs=1, locations=False):
+    """If spans is set, the module header (what comes before CONTAINS), types
+       and routines get recorded the span of their text within the buffer
+       and its hash. Given the AST of a previous parse with spans, the header
+       and the routines whose text did not change are taken from it instead
+       of being decoded again. The callgraph setting is recorded along with
+       the spans: previous is used only if it was parsed with the same one.
+       With jobs > 1, the routines are parsed by a pool of processes
+       (cf. parse_routines_parallel()), unless previous is given.
+       If locations is set, the module and every type, routine, interface
+       and variable within it get their 'location' (cf. InputStream.location()),
+       previous is then used only if it was parsed with locations too."""
+    ast = None
+    if(previous is not None and ('location' in previous) != bool(locations)):
+        previous = None
+    if(previous is not None and previous.get('callgraph') != bool(callgraph)):
+        previous = None # the routines lack, or have, their calls
+    if(previous is not None):
+        spans = True
+        ast = reuse_module_header(stream, previous)
+    if(ast is None):
+        ast = parse_module_header(stream, spans, locations)
+    if(spans):
+        ast['callgraph'] = bool(callgraph)
+
+    known = {}
+    if(previous is not None):
+        known = dict((s['hash'], s) for s in previous['subroutines'] + previous['functions'])
+    elif(jobs > 1):
+        for s in parse_routines_parallel(stream, jobs, callgraph, spans, locations) or []:
+            ast[s['tag']+'s'].append(s)
+
+    # parse stuff after CONTAINS
+    while(True):
+        line = stream.peek_next_fortran_line()
+        if(line.split(" ",1)[0] in ("SUBROUTINE", "FUNCTION", "ELEMENTAL", "PURE", "RECURSIVE")):
+            s = next_routine(stream, callgraph, spans, known, locations)
+            ast[s['tag']+'s'].append(s)
+        elif(match_var_decl(line)):
+            # when a variable declaration is found here it is actually a
+            # function with the inline declaration of the returned value type
+            assert("FUNCTION" in line)
+            s = next_routine(stream, callgraph, spans, known, locations)
+            assert(s['tag']=='function')
+            ast['functions'].append(s)
+        elif(re.match("^END ?MODULE", line)):
+            break # found module's closing line
+        else:
+            raise ParserException(line, stream.locus())
+
+    if(locations):
+        end_at = stream.peek_next_fortran_line(give_pos=True)[0] # the END MODULE line
+        ast['location'] = stream.location(0, stream.buffer.find("\n", end_at) + 1)
+
+    return(ast)
+
+#===============================================================================
+def parse_module_header(stream, spans=False, locations=False):
     doxygen = parse_doxygen(stream)
 
     # parse opening line
     kw, name = stream.next_fortran_line().split()
     assert(kw == "MODULE")
 
-    ast = {'tag':'module', 'name':name, 'descr':doxygen['brief'], 'uses':[], 'publics':[], 'types':[], 'subroutines':[], 'functions':[], 'interfaces':[], 'variables':[]}
+    ast = {'tag':'module', 'name':name, 'descr':doxygen['brief'], 'uses':[], 'publics':[], 'privates':[], 'types':[], 'subroutines':[], 'functions':[], 'interfaces':[], 'variables':[]}
 
     # parse stuff before CONTAINS
     private, save = False, False
-    private_syms = []
     while(True):
         line = stream.peek_next_fortran_line()
         if(line.startswith("USE ")):
@@ -71,19 +361,23 @@ def parse_module(stream):
             assert(vlist) # No executable statements allowed here!
             ast['variables'].extend(vlist)
             stream.next_fortran_line() # skip line
+            if(locations):
+                set_location(vlist, stream)
         elif(line.startswith("TYPE")):
             assert(not line.startswith("TYPE("))
-            t = parse_type(stream)
+            beg = stream.pos2 + 1
+            t = parse_type(stream, locations)
+            if(spans):
+                t['span'], t['hash'] = text_span(stream, beg)
             ast['types'].append(t)
         elif(line.startswith("PUBLIC")):
             syms = parse_pubpriv_statement(stream)
             ast['publics'].extend(syms)
         elif(line.startswith("PRIVATE")):
             syms = parse_pubpriv_statement(stream)
-            # only the name of these symbols is retained here
-            private_syms.extend([sym['name'] for sym in syms])
+            ast['privates'].extend(syms)
         elif(line.startswith("INTERFACE") or line.startswith("ABSTRACT INTERFACE")):
-            a =  parse_interface(stream)
+            a =  parse_interface(stream, locations)
             ast['interfaces'].append(a)
         elif(line == "CONTAINS"):
             stream.next_fortran_line() # skip line
@@ -94,31 +388,200 @@ def parse_module(stream):
             raise ParserException(line, stream.locus())
 
     # here all the PUBLIC/PRIVATE/SAVE/... statements/attributes should have been set!
-    set_visibility(ast['variables'], ast['publics'], private, private_syms)
+    set_visibility(ast['variables'], ast['publics'], private, [sym['name'] for sym in ast['privates']])
     set_staticness(ast['variables'], save)
+    if(not ast['privates']):
+        del ast['privates'] # recorded only when not empty
+    if(private):
+        ast['visibility'] = 'PRIVATE' # default one, e.g. of the routines: PUBLIC if missing
 
-    # parse stuff after CONTAINS
+    if(spans):
+        ast['header_span'], ast['header_hash'] = text_span(stream, 0)
+
+    return(ast)
+
+#===============================================================================
+def reuse_module_header(stream, previous):
+    """Return a copy of the previous module header if its text is unchanged,
+       the stream being then advanced past CONTAINS. Return None otherwise."""
+    state = stream.tell()
     while(True):
         line = stream.peek_next_fortran_line()
-        if(line.split(" ",1)[0] in ("SUBROUTINE", "FUNCTION", "ELEMENTAL", "PURE", "RECURSIVE")):
-            s = parse_routine(stream)
-            ast[s['tag']+'s'].append(s)
-        elif(match_var_decl(line)):
-            # when a variable declaration is found here it is actually a
-            # function with the inline declaration of the returned value type
-            assert("FUNCTION" in line)
-            s = parse_routine(stream)
-            assert(s['tag']=='function')
-            ast['functions'].append(s)
-        elif(re.match("^END ?MODULE", line)):
-            break # found module's closing line
+        if(re.match("^END ?MODULE", line)):
+            break
+        stream.next_fortran_line()
+        if(line == "CONTAINS"):
+            break
+    if(text_span(stream, 0)[1] != previous['header_hash']):
+        stream.seek(state)
+        return(None)
+    ast = deepcopy(dict((k, v) for k, v in previous.items() if not k in ('subroutines', 'functions')))
+    ast['subroutines'], ast['functions'] = [], []
+    return(ast)
+
+#===============================================================================
+def next_routine(stream, callgraph=False, spans=False, known=None, locations=False):
+    """Parse the routine coming next in the stream. If the hash of its text is
+       among the known routines (hash -> AST), a copy of that one is returned."""
+    beg = stream.pos2 + 1
+    if(known):
+        state = stream.tell()
+        skip_routine(stream)
+        span, text_hash = text_span(stream, beg)
+        if(text_hash in known):
+            s = deepcopy(known[text_hash])
+            s['span'] = span
+            if(locations):
+                shift_locations(s, stream.location(*span))
+            return(s)
+        stream.seek(state)
+    s = parse_routine(stream, callgraph, locations)
+    if(spans):
+        s['span'], s['hash'] = text_span(stream, beg)
+    return(s)
+
+#===============================================================================
+# below that much text, the routines are parsed faster than a pool starts
+PARALLEL_MIN_BYTES = 256 * 1024
+
+def parse_routines_parallel(stream, jobs, callgraph=False, spans=False, locations=False):
+    """Parse the routines coming next in the stream on a pool of jobs processes.
+       A cheap prepass over the raw buffer finds where the routines end, they
+       are then split in chunks: each worker parses its chunks from the stream
+       state at their beginning, so that the locus stays right. Workers check
+       that each routine ends where the prepass said, if any does not (or
+       fails to parse) the stream is left untouched and None is returned:
+       the routines are to be parsed sequentially. The diagnostics printed
+       by the workers are held back, so that they are printed only once:
+       by the sequential parse in that case.
+       Otherwise the ASTs are returned in source order and the stream is
+       left past the last routine. None is returned as well, right away,
+       when the routines are too few to pay for starting the pool: less than
+       PARALLEL_MIN_BYTES of text left, or less than two routines."""
+    if(len(stream.buffer) - (stream.pos2 + 1) < PARALLEL_MIN_BYTES):
+        return(None)
+    ends = find_routine_ends(stream.buffer, stream.pos2 + 1)
+    if(len(ends) < 2):
+        return(None)
+
+    n_chunks = min(len(ends), 4*jobs) # a few chunks per worker, to balance the load
+    bounds = [stream.pos2 + 1] + ends
+    chunks = []
+    for i in range(n_chunks):
+        i1, i2 = i*len(ends)//n_chunks, (i+1)*len(ends)//n_chunks
+        chunks.append( (stream.tell_at(bounds[i1]), ends[i1:i2], callgraph, spans, locations) )
+
+    pool = multiprocessing.Pool(jobs, init_routines_worker, (stream.filename, stream.buffer))
+    try:
+        results = pool.map(parse_routines_chunk, chunks)
+    finally:
+        pool.terminate()
+    if(None in results):
+        return(None)
+    for routines, output, n_lines in results:
+        sys.stdout.write(output)
+        stream.n_fortran_lines += n_lines
+    stream.seek(stream.tell_at(ends[-1]))
+    return(list(chain(*[routines for routines, output, n_lines in results])))
+
+#===============================================================================
+# A raw line opening or closing (END) a routine, not normalized: it is a guess
+ROUTINE_KEYWORD_REGEX = re.compile("SUBROUTINE|FUNCTION", re.I)
+ROUTINE_BOUNDARY_REGEX = re.compile(r"[ \t]*(?:(END)[ \t]*(?:SUBROUTINE|FUNCTION)\b|(?:[\w(),=*: \t]*[ \t])?(?:SUBROUTINE|FUNCTION)[ \t]+\w)", re.I)
+
+def find_routine_ends(buffer, pos):
+    """Return the positions right after the lines closing the routines found
+       in buffer from pos onwards, nested routines and interfaces excluded"""
+    ends = []
+    depth = 0
+    line_end = pos
+    for k in ROUTINE_KEYWORD_REGEX.finditer(buffer, pos):
+        if(k.start() < line_end):
+            continue # this line was already looked at
+        line_beg = buffer.rfind("\n", 0, k.start()) + 1
+        line_end = buffer.find("\n", k.end()) + 1
+        m = ROUTINE_BOUNDARY_REGEX.match(buffer, line_beg, line_end)
+        if(not m):
+            continue
+        elif(not m.group(1)):
+            depth += 1
+        elif(depth == 0):
+            return([]) # unbalanced, something went wrong
         else:
-            raise ParserException(line, stream.locus())
+            depth -= 1
+            if(depth == 0):
+                ends.append(line_end)
+    return(ends)
 
-    return(ast)
+#===============================================================================
+def init_routines_worker(filename, buffer):
+    global worker_stream
+    worker_stream = InputStream(filename, buffer=buffer)
 
 #===============================================================================
-def parse_interface(stream):
+def parse_routines_chunk(args):
+    """Parse the routines from the given stream state, return them along with
+       what got printed meanwhile and the number of logical lines read.
+       Return None if any of them does not end at the expected position or
+       cannot be parsed."""
+    state, ends, callgraph, spans, locations = args
+    worker_stream.seek(state)
+    worker_stream.reset_count()
+    routines = []
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        for end in ends:
+            routines.append(next_routine(worker_stream, callgraph, spans, locations=locations))
+            if(worker_stream.pos2 + 1 != end):
+                return(None)
+    except Exception:
+        return(None) # let the sequential parse report it
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+    return(routines, output, worker_stream.n_fortran_lines)
+
+#===============================================================================
+def text_span(stream, beg):
+    """Return the span of the text from beg to the end of the last line read
+       from the stream, along with its hash"""
+    end = stream.pos2 + 1
+    return((beg, end), hashlib.sha1(to_bytes(stream.buffer[beg:end])).hexdigest())
+
+#===============================================================================
+def set_location(nodes, stream):
+    """Give the nodes (e.g. variables) the location of the statement just read"""
+    location = stream.location(stream.pos1, stream.pos2 + 1)
+    for node in nodes:
+        node['location'] = dict(location)
+
+#===============================================================================
+LOCATION_KEYS = ('lines', 'offsets', 'buffer_lines', 'buffer_offsets')
+
+def shift_locations(node, location):
+    """Move the locations within a copy of a node parsed before, its text being
+       the same but now found at the given location. Those coming from another
+       file than the node's (i.e. an included one) keep their place there."""
+    old = node['location']
+    deltas = dict((k, location[k][0] - old[k][0]) for k in LOCATION_KEYS
+                  if old[k] is not None and location[k] is not None)
+    def walk(x):
+        if(isinstance(x, list)):
+            for y in x:
+                walk(y)
+        elif(isinstance(x, dict)):
+            for y in x.values():
+                walk(y)
+            loc = x.get('location')
+            if(loc):
+                for k in LOCATION_KEYS:
+                    if(k.startswith("buffer_") or loc['file'] == old['file']):
+                        loc[k] = tuple(v + deltas[k] for v in loc[k]) if k in deltas and loc[k] else None
+    walk(node)
+    node['location'] = location
+
+#===============================================================================
+def parse_interface(stream, locations=False):
+    beg = stream.pos2 + 1
     raw_line = stream.next_fortran_line()
     prefix, line = re.match("(ABSTRACT )?(INTERFACE.*)", raw_line).groups()
     assert(line.startswith("INTERFACE"))
@@ -145,7 +608,7 @@ def parse_interface(stream):
                 assert(ast['task'] == 'explicit_interface')
             else:
                 ast['task'] = 'explicit_interface'
-            f = parse_routine(stream)
+            f = parse_routine(stream, locations=locations)
             assert(f['tag'] in ("subroutine", "function"))
             ast['procedures'].append(f)
     # abstract interfaces
@@ -154,15 +617,18 @@ def parse_interface(stream):
         assert(not name)
         name = ast['procedures'][0]['name']
         ast.update( {'name':name, 'task':'abstract_interface'} )
+    if(locations):
+        ast['location'] = stream.location(beg, stream.pos2 + 1)
     return(ast)
 
 #===============================================================================
-def parse_type(stream):
+def parse_type(stream, locations=False):
+    beg = stream.pos2 + 1
     doxygen = parse_doxygen(stream)
 
     line = stream.next_fortran_line()
     assert(line.startswith("TYPE"))
-    attrlist, sep, name = re.match("TYPE(,BIND\(.*\))?( |::)(.+)", line).groups()
+    attrlist, sep, name = re.match(r"TYPE(,BIND\(.*\))?( |::)(.+)", line).groups()
     ast = {'tag':'type', 'name':name, 'descr':doxygen['brief'], 'variables':[]}
 
     if attrlist:
@@ -180,11 +646,15 @@ def parse_type(stream):
             vlist = parse_var_decl(line)
             assert(vlist) # No executable statements allowed here!
             ast['variables'].extend(vlist)
+            if(locations):
+                set_location(vlist, stream)
         else:
             raise ParserException(line, stream.locus())
 
     set_visibility(ast['variables'], [], private)
     commit_type_members_descr(ast, doxygen)
+    if(locations):
+        ast['location'] = stream.location(beg, stream.pos2 + 1)
 
     return(ast)
 
@@ -265,7 +735,7 @@ def parse_var_decl(line):
             assert(sep==' ')
             assert(re.match("[A-Z]+$",vtype))
         else:
-            assert(re.match("[A-Z]+\(.+\)$",vtype))
+            assert(re.match(r"[A-Z]+\(.+\)$",vtype))
 
     # Now deal with attributes
     attrs = get_attributes(attrlist)
@@ -286,12 +756,12 @@ def get_attributes(attrlist):
             assert(not v)
             attrs['keywd_attrs'].append(k)
         elif(k ==  "INTENT"):
-            m = re.match("\(([A-Z]+)\)$", v)
+            m = re.match(r"\(([A-Z]+)\)$", v)
             intent = m.group(1)
             assert(intent in ("IN", "OUT", "INOUT"))
             attrs['intent'] = intent
         elif(k ==  "DIMENSION" or k == "BIND"):
-            m = re.match("(\(.+\))$", v)
+            m = re.match(r"(\(.+\))$", v)
             assert(m)
             attrs[k.lower()] = v
         else:
@@ -349,7 +819,7 @@ def get_var_type(string):
 
     # kw must match the whole identifier at the beginning of the string
     #   if not: this is not a variable declaration!
-    if kw != re.match("\w+", string).group(0):
+    if kw != re.match(r"\w+", string).group(0):
         return
 
     ppattern = ""
@@ -398,14 +868,15 @@ def get_variables(varlist, vtype, attrs):
     """Return a list. Each list item is a dictionary related to a variable found in the input string.
        Each variable comes with its name and eventually attributes (dimension, intent, ...) or initialization."""
     assert(varlist)
-    dim_from_attrs = next((re.match("DIMENSION(\(.+\))$",a).group(1) for a in attrs if a.startswith("DIMENSION(")), None)
+    dim_from_attrs = next((re.match(r"DIMENSION(\(.+\))$",a).group(1) for a in attrs if a.startswith("DIMENSION(")), None)
     variables = []
     varlist += ","
-    while(varlist):
-        v = get_next_variable(varlist)
+    pos = 0 # not slicing varlist: long lists would be copied over and over
+    while(pos < len(varlist)):
+        v = get_next_variable(varlist, pos)
         to_skip = v.pop('raw') + ","
-        assert(varlist.startswith(to_skip))
-        varlist = varlist[ len(to_skip) : ]  # skip the successfully processed variable
+        assert(varlist.startswith(to_skip, pos))
+        pos += len(to_skip)  # skip the successfully processed variable
 
         # update the variable with the common info
         v['type'] = vtype
@@ -420,19 +891,22 @@ def get_variables(varlist, vtype, attrs):
     return variables
 
 #===============================================================================
-def get_next_variable(string):
-    """Decode variable list: return the first variable found in the input string.
+WORD_REGEX = re.compile(r"\w+")
+
+def get_next_variable(string, pos=0):
+    """Decode variable list: return the first variable found in the input string,
+       starting at index pos.
        A State-machine is used to deal with nested parentheses or inline
        initialization (eventually with quoted strings)."""
-    m = re.match("(\w+)(.*)",string)
-    name, postfix = m.groups()
+    m = WORD_REGEX.match(string, pos)
+    name = m.group(0)
     v = {'tag':'variable', 'name':name, 'dim':''}
     n_opened = 0
     n_square = 0
     state = "start"
-    ichar = 0
+    ichar = m.end()
     while(True):  # process char by char what is beyond the identifier
-        c = postfix[ichar]
+        c = string[ichar]
 
         if(state=="start"):
             if(c == ','):
@@ -446,7 +920,7 @@ def get_next_variable(string):
                 ppattern = c
                 state = "p_open%" + state
             else:
-                raise SM_UnknownCharException(c,state,string[:-1])
+                raise SM_UnknownCharException(c,state,string[pos:-1])
 
         elif(state=="init"):
             if(c == ','):
@@ -454,7 +928,7 @@ def get_next_variable(string):
             elif(c == "'" or c == '"'):
                 v['init'] += c
                 state = "str:"+c
-            elif(re.match('\w', c)):
+            elif(re.match(r'\w', c)):
                 v['init'] += c
             elif(c in ('+','-','*','/','.','>','%','=')):
                 v['init'] += c
@@ -469,7 +943,7 @@ def get_next_variable(string):
                 sqpattern = c
                 state = "sq_open%" + state
             else:
-                raise SM_UnknownCharException(c,state,string[:-1])
+                raise SM_UnknownCharException(c,state,string[pos:-1])
 
         elif(state.startswith("str:")):  # this state can only be reached from "init"
             v['init'] += c
@@ -516,24 +990,25 @@ def get_next_variable(string):
     return v
 
 #===============================================================================
-def parse_routine(stream):
+ROUTINE_REGEX = re.compile(r'(.*)(FUNCTION|SUBROUTINE) (\w+)(?:\((.*?)\))?(.*)')
+#                           |   |                     |    |    |        |
+#                           |   |                     |    |    |        .
+#                           |   |                     |    |    |         \..postfix: RESULT(..) | BIND(..)
+#                           |   |                     |    |    .
+#                           |   |                     |    |     \..arguments list
+#                           |   |                     |    .
+#                           |   |                     |     \..[non-capturing group: the "()" empty list of arguments can be omitted]
+#                           |   .                     .
+#                           |    \..whatis             \..name
+#                           .
+#                            \..prefix: RECURSIVE | PURE | ...
+
+def parse_routine(stream, callgraph=False, locations=False):
+    beg = stream.pos2 + 1
     doxygen = parse_doxygen(stream)
 
     line1 = stream.next_fortran_line()
-    regex = re.compile('(.*)(FUNCTION|SUBROUTINE) (\w+)(?:\((.*?)\))?(.*)') # it is used afterwards too...
-    #                   |   |                     |    |    |        |
-    #                   |   |                     |    |    |        .
-    #                   |   |                     |    |    |         \..postfix: RESULT(..) | BIND(..)
-    #                   |   |                     |    |    .
-    #                   |   |                     |    |     \..arguments list
-    #                   |   |                     |    .
-    #                   |   |                     |     \..[non-capturing group: the "()" empty list of arguments can be omitted]
-    #                   |   .                     .
-    #                   |    \..whatis             \..name
-    #                   .
-    #                    \..prefix: RECURSIVE | PURE | ...
-
-    m = regex.match(line1)
+    m = ROUTINE_REGEX.match(line1)
     prefix, whatis, name, args, postfix = m.groups()
     ast = {
      'tag':whatis.lower(),
@@ -562,13 +1037,17 @@ def parse_routine(stream):
                 break  # this line isn't actually a variable declaration!
             var_decl_list.extend( vlist )
             stream.next_fortran_line() # advance stream
+            if(locations):
+                set_location(vlist, stream)
 
         # we could have a function/subroutine as argument!
         elif(line.startswith("INTERFACE")):
-            intfc = parse_interface(stream)
+            intfc = parse_interface(stream, locations)
             assert(not intfc['name'] and len(intfc['procedures'])==1)
             f = intfc['procedures'].pop()
             var_decl_list.append( {'name':f['name'], 'type':'PROCEDURE', 'attrs':[f['tag']], 'dim':None} )
+            if(locations):
+                var_decl_list[-1]['location'] = intfc['location']
 
         # explicitly handle the following cases, if we don't, the scan for arguments type declaration will end prematurely!
         #
@@ -578,7 +1057,7 @@ def parse_routine(stream):
             ast['uses'].append(u)
         elif(line.startswith("TYPE")):
             assert(not line.startswith("TYPE("))
-            t = parse_type(stream)
+            t = parse_type(stream, locations)
             ast['types'].append(t)
         #
         #   ...deferred attributes
@@ -586,13 +1065,13 @@ def parse_routine(stream):
             vlist = get_variables(re.match("DIMENSION( |::)(.+)",line).group(2), vtype='UNKNOWN', attrs=[] )
             dimensions.update(dict( (v['name'], v['dim']) for v in vlist ))
             stream.next_fortran_line()
-        elif(re.split('\W+',line,1)[0] in ('ALLOCATABLE', 'EXTERNAL')):
+        elif(re.split(r'\W+',line,maxsplit=1)[0] in ('ALLOCATABLE', 'EXTERNAL')):
             kw, sep, vlist = re.match("(ALLOCATABLE|EXTERNAL)( |::)(.+)", line).groups()
             assert(not set(vlist.split(",")).intersection(a['name'] for a in ast['args'])) # TODO
             stream.next_fortran_line()
         #
         #   ...these attributes conflict with the "DUMMY" attribute of an argument, they can be safely ignored
-        elif(re.match("PARAMETER\((.+)\)", line)):
+        elif(re.match(r"PARAMETER\((.+)\)", line)):
             stream.next_fortran_line()
         elif(re.match("SAVE( |::)(.+)", line)):
             stream.next_fortran_line()
@@ -616,25 +1095,75 @@ def parse_routine(stream):
     commit_retval_type(ast, var_decl_list, dimensions)
 
     # skip over subroutines body and ignore nested subroutines
+    #   (the calls found in the nested ones are credited to this routine)
+    if(not callgraph):
+        skip_routine_body(stream, whatis)
+    else:
+        calls, func_refs = set(), set()
+        skip_routine_body(stream, whatis, calls, func_refs)
+        # whatever is declared here is a variable, not a function
+        local_names = set(v['name'] for v in var_decl_list)
+        if(ast['retval']):
+            local_names.add(ast['retval']['name'])
+        ast['calls'] = sorted(calls)
+        ast['func_refs'] = sorted(func_refs - local_names)
+
+    if(locations):
+        ast['location'] = stream.location(beg, stream.pos2 + 1)
+    return(ast)
+
+#===============================================================================
+def skip_routine_body(stream, whatis, calls=None, func_refs=None):
+    """Advance the stream past the END line of the current routine, skipping
+       over its body and its nested routines. If the calls and func_refs sets
+       are given, the names called there are collected (cf. collect_calls())."""
     stack = [whatis]
-    while(True):
+    while(stack):
         line = stream.next_fortran_line()
-        m = regex.match(line)
+        m = ROUTINE_REGEX.match(line)
         if(re.match("^END ?SUBROUTINE", line)):
-            assert(stack.pop() == "SUBROUTINE")
+            closed = stack.pop() # not within the assert, it would go with -O
+            assert(closed == "SUBROUTINE")
         elif(re.match("^END ?FUNCTION", line)):
-            assert(stack.pop() == "FUNCTION")
-        elif(m):
-            prefix, inner_whatis, name, args, postfix = m.groups()
-            if(
-               all((a in ("ELEMENTAL", "PURE", "RECURSIVE") or match_var_decl(a)) for a in prefix.split())
+            closed = stack.pop()
+            assert(closed == "FUNCTION")
+        elif(m and
+               all((a in ("ELEMENTAL", "PURE", "RECURSIVE") or match_var_decl(a)) for a in m.group(1).split())
             ):
-                stack.append( inner_whatis )
+            stack.append( m.group(2) )
+        elif(calls is not None):
+            collect_calls(line, calls, func_refs)
 
-        if(not stack):
-            break
+#===============================================================================
+def skip_routine(stream):
+    """Advance the stream past the routine coming next, without decoding it"""
+    m = ROUTINE_REGEX.match(stream.next_fortran_line())
+    skip_routine_body(stream, m.group(2))
 
-    return(ast)
+#===============================================================================
+# Statements whose keyword is followed by a parenthesis, they are not function references
+NONCALL_KEYWORDS = frozenset((
+    "IF", "WHILE", "CASE", "IS", "TYPE", "CLASS", "WHERE", "FORALL", "ASSOCIATE",
+    "ALLOCATE", "DEALLOCATE", "NULLIFY", "READ", "WRITE", "OPEN", "CLOSE",
+    "INQUIRE", "REWIND", "BACKSPACE", "ENDFILE", "FLUSH", "WAIT", "FORMAT",
+    "RETURN", "STOP", "CHARACTER", "INTEGER", "REAL", "COMPLEX", "LOGICAL",
+))
+CALL_REGEX = re.compile(r"(?<![%\w])CALL ([A-Z]\w*)(?![%\w])")
+FUNC_REF_REGEX = re.compile(r"(?<![%\w])(?<!CALL )([A-Z]\w*)\(")
+STRING_REGEX = re.compile(r"'[^']*'|\"[^\"]*\"")
+
+#===============================================================================
+def collect_calls(line, calls, func_refs):
+    """Add to the calls set the subroutines called in a (normalized) fortran line
+       and to the func_refs set the names that could be function references.
+       The latter cannot be told apart from arrays or intrinsics here: it is
+       up to the consumer to filter them against the known functions."""
+    if("'" in line or '"' in line):
+        line = STRING_REGEX.sub("''", line)
+    if("CALL " in line):
+        calls.update(CALL_REGEX.findall(line))
+    if("(" in line):
+        func_refs.update(n for n in FUNC_REF_REGEX.findall(line) if not n in NONCALL_KEYWORDS)
 
 #===============================================================================
 def decode_args(ast, args):
@@ -655,7 +1184,7 @@ def decode_prefix(ast, prefix):
 
 #===============================================================================
 def decode_postfix(ast, postfix):
-    for item, what, content in re.findall("((RESULT|BIND)\((.+?)\))", postfix.strip()):
+    for item, what, content in re.findall(r"((RESULT|BIND)\((.+?)\))", postfix.strip()):
         if( what == "RESULT" ):
             # update the return value name
             ast['retval']['name'] = content
@@ -667,13 +1196,17 @@ def decode_postfix(ast, postfix):
 #===============================================================================
 def commit_arg_type(ast, var_decl_list, dimensions):
 
-    # support list of variables names
-    vnamelist = [v['name'] for v in var_decl_list]
+    # support list of variables names, the first declaration of each
+    vnames = {}
+    for v in var_decl_list:
+        vnames.setdefault(v['name'], v)
 
     for a in ast['args']:
         # set type and attributes
-        v = var_decl_list[ vnamelist.index(a['name']) ]
+        v = vnames[a['name']]
         a.update( {'type':v['type'], 'attrs':v['attrs'], 'dim':v['dim']} )
+        if('location' in v):
+            a['location'] = v['location'] # that of the declaration
         # optionally update dimension
         if( a['name'] in dimensions ):
             if( a['dim'] ):
@@ -682,7 +1215,7 @@ def commit_arg_type(ast, var_decl_list, dimensions):
                 a['dim'] = dimensions[a['name']]
 
     # final check
-    assert( all(a.has_key('type') for a in ast['args']) )
+    assert( all('type' in a for a in ast['args']) )
 
 #===============================================================================
 def commit_retval_type(ast, var_decl_list, dimensions):
@@ -697,6 +1230,8 @@ def commit_retval_type(ast, var_decl_list, dimensions):
         if(a['name'] in vnamelist):
             v = var_decl_list[ vnamelist.index(a['name']) ]
             a.update( {'type':v['type'], 'attrs':v['attrs'], 'dim':v['dim']} )
+            if('location' in v):
+                a['location'] = v['location']
         else:
             # it should have been assigned in decode_prefix()
             assert(a['type'])
@@ -706,10 +1241,12 @@ def commit_args_descr(ast, doxygen):
 
     assert(not doxygen['var'])
 
-    anames = [arg['name'] for arg in ast['args']]
-    for var, descr in doxygen['param'].iteritems():
-        if(isinstance(var, basestring) and var in anames):
-            ast['args'][anames.index(var)]['descr'] = descr
+    anames = {}
+    for arg in ast['args']:
+        anames.setdefault(arg['name'], arg)
+    for var, descr in doxygen['param'].items():
+        if(isinstance(var, str) and var in anames):
+            anames[var]['descr'] = descr
         elif(isinstance(var, tuple) and all(vv in anames for vv in var)):
             ast.setdefault('__grouped_args_descr__',[]).append( {'grouped_args':var, 'descr':descr} )
 
@@ -717,8 +1254,8 @@ def commit_args_descr(ast, doxygen):
         doxytag = doxygen['retval']
         if doxytag:
             assert(len(doxytag)==1)
-            doxyretvalname = doxytag.keys()[0]
-            assert(isinstance(doxyretvalname, basestring))
+            doxyretvalname = list(doxytag)[0]
+            assert(isinstance(doxyretvalname, str))
 
             a = ast['retval']['name']
             descr = doxytag[a] if(doxyretvalname == a) else ""
@@ -732,8 +1269,8 @@ def commit_args_descr(ast, doxygen):
 #===============================================================================
 def commit_type_members_descr(ast, doxygen):
     names = [v['name'] for v in ast['variables']]
-    for var, descr in chain(doxygen['var'].iteritems(), doxygen['param'].iteritems()):
-        if(isinstance(var, basestring) and var in names):
+    for var, descr in chain(doxygen['var'].items(), doxygen['param'].items()):
+        if(isinstance(var, str) and var in names):
             ast['variables'][names.index(var)]['descr'] = descr
         elif(isinstance(var, tuple) and all(vv in names for vv in var)):
             ast.setdefault('__grouped_vars_descr__',[]).append( {'grouped_args':var, 'descr':descr} )
@@ -794,7 +1331,7 @@ def parse_doxygen(stream):
             if(entries):
                 entries[-1][1] += " " + line.split("!>",1)[1].strip()
             else: # the Doxygen comment but with no tag
-                print '*** Error location: Doxygen block above', stream.locus()
+                print('*** Error location: Doxygen block above', stream.locus())
                 assert False # Doxy with no tag??
         line = stream.next_line() # advance stream
 
@@ -808,14 +1345,14 @@ def parse_doxygen(stream):
         elif(k == "param" or k == "retval" or k == "var"):
             # Filter out [in], [out], ... and (optional) right after the tag,
             #   they otherwise will hide the argument...
-            v = re.sub("^\[(int|in|out|in[.,]? ?out)\]", "", v, count=1).strip()
-            v = re.sub("^\((optinal|optional)\)", "", v, count=1).strip()
+            v = re.sub(r"^\[(int|in|out|in[.,]? ?out)\]", "", v, count=1).strip()
+            v = re.sub(r"^\((optinal|optional)\)", "", v, count=1).strip()
             if(v):
                 try:
                     doxyvar = parse_doxyvar(v)
                 except (SM_UnknownCharException, SM_InvalidStateException):
                    #raise Exception('*** Error location: Doxygen block above %s' % stream.locus())
-                    print '*** Error location: Doxygen block above', stream.locus()
+                    print('*** Error location: Doxygen block above', stream.locus())
                 else:
                     doxygen[k].update( doxyvar )
         else:
@@ -824,169 +1361,160 @@ def parse_doxygen(stream):
 
     return(doxygen)
 
+#===============================================================================
+# Character classes and transition table of the state machine that decodes the
+#   variable names of a doxygen \param, \retval or \var tag:
+#     (state, character class) -> (action, next state)
+DOXYVAR_CHAR_CLASS = dict(
+    [(c, "word") for c in string.ascii_letters + string.digits + "_"] +
+    [(" ", "blank"), (",", "comma"), (":", "colon"), (".", "dot"),
+     ("!", "bang"), ("(", "round"), ("[", "square")] +
+    [(c, "descr") for c in (
+        "*",    # used to emphasize something, used by doxygen, not yet by ast2doc, see:
+                #   pint_staging.F:123, pint_normalmode.F:217
+
+        "'",    # the description can be started via a quoted string, doxygen seems to handle it
+        '"',    # see:
+                #   kpoint_types.F:115, kpoint_types.F:286, kpoint_types.F:394, dbcsr_types.F:419,
+                #   dbcsr_work_operations.F:164, dbcsr_operations.F:1504
+
+        "|",    # is a shourtcut for norm (e.g.: || grad rho ||);
+                # doxygen seems to handle it!
+                # see:
+                #   xc_b97.F:538, xc_b97.F:1559, xc_lyp.F:901,
+                #   xc_xbecke88.F:821, xc_xbecke88_long_range.F:259,
+                #   xc_xbecke88_long_range.F:1033, xc_xbecke88_lr_adiabatic.F:265,
+                #   xc_xbecke88_lr_adiabatic.F:3043, xc_xbeef.F:419
+
+        "=",    # there are some formulas... TODO: how to handle them?
+    )]
+)
+
+DOXYVAR_TRANSITIONS = {
+    ("start", "word"):  ("new_var", "ini_varname"),
+    ("start", "bang"):  ("no_var", None),
+        # TODO: issue with SUBROUTINE pbe_lda_calc (src/xc/xc_pbe.F):
+        #   there is a commented line in between the arguments
+        #   so doxify.sh gets confused and adds a "!" \param...
+
+    ("ini_varname", "word"):  ("extend_var", "ini_varname"),
+    ("ini_varname", "blank"): (None, "waiting_for_nextvar_or_descr"),
+    ("ini_varname", "comma"): (None, "waiting_for_next_var_name"),
+    ("ini_varname", "colon"): (None, "got_varnames"),
+        # TODO: colon used as a separator between
+        #   the var name(s) and the description... Tolerated?
+    ("ini_varname", "round"): ("round", "ini_varname"),
+
+    ("waiting_for_next_var_name", "blank"): (None, "waiting_for_next_var_name"),
+    ("waiting_for_next_var_name", "word"):  ("new_var", "ini_varname"),
+}
+for state in ("waiting_for_nextvar_or_descr", "got_varnames"):
+    DOXYVAR_TRANSITIONS.update({
+        (state, "blank"):  (None, state),   # go on stripping consecutive blanks
+        (state, "comma"):  (None, "waiting_for_next_var_name"),
+        (state, "colon"):  (None, "got_varnames"),
+        (state, "dot"):    ("dot", state),  # ellipsis or .TRUE./.FALSE.
+        (state, "word"):   ("descr", "got_descr"), # a word here starts the description
+        (state, "descr"):  ("descr", "got_descr"),
+        (state, "round"):  ("round", state),  # we'll ignore info like (optional): we rely on the proper attribute!
+        (state, "square"): ("square", state), # we'll ignore info like [output], ...: we rely on "INTENT" attribute!
+    })
+del state
+
+# bracketed info tolerated between the variable names and the description
+DOXYVAR_IGNORED = {"round": ("(optional)", ), "square": ("[output]", "[input]", "[OPTIONAL]")}
+WORD_RUN_REGEX = re.compile("[A-Za-z0-9_]*")
+
 #===============================================================================
 def parse_doxyvar(tag_content):
     varlist = []
-    n_opened, n_square = 0, 0
     state = "start"
-    for i, c in enumerate(tag_content):
-        my_string = tag_content[:i] + "{" + tag_content[i] + "}" + tag_content[i+1:]
-
-        if(state=="start"):
-            if(re.match("\w", c)):
-                varlist.append(c)  # 1st char of the variable name
-                state = "ini_varname"
-            elif(c=='!'):
-                # TODO: issue with SUBROUTINE pbe_lda_calc (src/xc/xc_pbe.F):
-                #   there is a commented line in between the arguments
-                #   so doxify.sh gets confused and adds a "!" \param...
-                return(dict())
-            else:
-                raise SM_UnknownCharException(c,state,my_string)
-
-        elif(state=="ini_varname"):
-            if(re.match("\w", c)):
-                varlist[-1] += c  # completion of the variable name
-            elif(c==' '):
-                state = "waiting_for_nextvar_or_descr"
-            elif(c==','):
-                state = "waiting_for_next_var_name"
-            elif(c==':'):
-                # TODO: colon used as a separator between
-                #   the var name(s) and the description... Tolerated?
-                state = "got_varnames"
-            elif(c=='('):
-                assert(n_opened==0)
-                i_round_beg = i
-                n_opened = 1
-                ppattern = c
-                state = "p_open%" + state
+    i = 0
+    while(i < len(tag_content)):
+        c = tag_content[i]
+        try:
+            action, next_state = DOXYVAR_TRANSITIONS[(state, DOXYVAR_CHAR_CLASS.get(c))]
+        except KeyError:
+            raise SM_UnknownCharException(c, state, doxyvar_error_context(tag_content, i))
+
+        if(action == "new_var" or action == "extend_var"):
+            # consume the whole run of word chars at once
+            j = WORD_RUN_REGEX.match(tag_content, i+1).end()
+            if(action == "new_var"):
+                varlist.append(tag_content[i:j])
             else:
-                raise SM_UnknownCharException(c,state,my_string)
+                varlist[-1] += tag_content[i:j]
+            i = j - 1
 
-        elif(state=="waiting_for_nextvar_or_descr" or state=="got_varnames"):
-            if(c==' '):
-                # go on stripping consecutive blanks
-                pass
-            elif(c==','):
-                state = "waiting_for_next_var_name"
-            elif(c==':'):
-                # TODO: colon used as a separator between
-                #   the var name(s) and the description... Tolerated?
-                state = "got_varnames"
-            elif(c=='.'):
-                descr = tag_content[i:]
-                if(descr=='...'):
-                    # could be either ellipsis: "..." (missing description)
-                    return(dict())
-                elif(re.match("\.(true|false)\.", descr, re.I)):
-                    # ...or a description can be started via ".TRUE." / ".FALSE."
-                    state = "got_descr"
-                    break
-                else:
-                    raise SM_UnknownCharException(c,state,my_string)
-            elif(
-              re.match("\w", c) or  # a word here starts the description
-              c in (
-
-                "*",    # used to emphasize something, used by doxygen, not yet by ast2doc, see:
-                        #   pint_staging.F:123, pint_normalmode.F:217
-
-                "'",    # the description can be started via a quoted string, doxygen seems to handle it
-                '"',    # see:
-                        #   kpoint_types.F:115, kpoint_types.F:286, kpoint_types.F:394, dbcsr_types.F:419,
-                        #   dbcsr_work_operations.F:164, dbcsr_operations.F:1504
-
-                "|",    # is a shourtcut for norm (e.g.: || grad rho ||);
-                        # doxygen seems to handle it!
-                        # see:
-                        #   xc_b97.F:538, xc_b97.F:1559, xc_lyp.F:901,
-                        #   xc_xbecke88.F:821, xc_xbecke88_long_range.F:259,
-                        #   xc_xbecke88_long_range.F:1033, xc_xbecke88_lr_adiabatic.F:265,
-                        #   xc_xbecke88_lr_adiabatic.F:3043, xc_xbeef.F:419
-
-                "=",    # there are some formulas... TODO: how to handle them?
-
-              )
-            ):
-                descr = tag_content[i:]
+        elif(action == "no_var"):
+            return(dict())
+
+        elif(action == "descr"):
+            state = next_state
+            break
+
+        elif(action == "dot"):
+            descr = tag_content[i:]
+            if(descr=='...'):
+                # could be either ellipsis: "..." (missing description)
+                return(dict())
+            elif(re.match(r"\.(true|false)\.", descr, re.I)):
+                # ...or a description can be started via ".TRUE." / ".FALSE."
                 state = "got_descr"
                 break
-            elif(c=='('):
-                # we'll ignore info like (optional): we rely on the proper attribute!
-                assert(n_opened==0)
-                i_round_beg = i
-                n_opened = 1
-                ppattern = c
-                state = "p_open%" + state
-            elif(c=='['):
-                # we'll ignore info like [output], ...: we rely on "INTENT" attribute!
-                assert(n_square==0)
-                i_square_beg = i
-                n_square = 1
-                sqpattern = c
-                state = "sq_open%" + state
             else:
-                raise SM_UnknownCharException(c,state,my_string)
-
-        elif(state=="waiting_for_next_var_name"):
-            if(c==' '):
-                pass
-            elif(re.match("\w", c)):
-                varlist.append(c)
-                state = "ini_varname"
-            else:
-                raise SM_UnknownCharException(c,state,my_string)
-
-        elif(state.startswith("p_open%")):
-            ppattern += c
-            if(c == "("):
-                n_opened += 1
-            elif(c == ")"):
-                n_opened -= 1
-                if(n_opened==0):
-                    # check on previous state
-                    prev_state = state.split("%",1)[1]
-                    if(not prev_state in ("ini_varname", "waiting_for_nextvar_or_descr")):
-                        raise SM_InvalidStateException('previous', prev_state, tag_content)
-                    state = prev_state
-                    # check on the round braket content
-                    if(not ppattern in ("(optional)", )):
-                        descr = tag_content[i_round_beg:]
-                        state = "got_descr"
-                        break
-
-        elif(state.startswith("sq_open%")):
-            sqpattern += c
-            if(c == "["):
-                n_square += 1
-            elif(c == "]"):
-                n_square -= 1
-                if(n_square==0):
-                    # check on previous state
-                    prev_state = state.split("%",1)[1]
-                    if(not prev_state in ("waiting_for_nextvar_or_descr", "got_varnames")):
-                        raise SM_InvalidStateException('previous', prev_state, tag_content)
-                    state = prev_state
-                    # check on the square braket content
-                    if(not sqpattern in ("[output]", "[input]", "[OPTIONAL]")):
-                        descr = tag_content[i_square_beg:]
-                        state = "got_descr"
-                        break
+                raise SM_UnknownCharException(c, state, doxyvar_error_context(tag_content, i))
+
+        elif(action == "round" or action == "square"):
+            prefix = "p_open%" if action == "round" else "sq_open%"
+            j = find_closing_bracket(tag_content, i)
+            if(j < 0):
+                raise SM_InvalidStateException('final', prefix + state, tag_content)
+            # check on previous state
+            if(action == "round" and not state in ("ini_varname", "waiting_for_nextvar_or_descr")):
+                raise SM_InvalidStateException('previous', state, tag_content)
+            # check on the braket content
+            if(not tag_content[i:j+1] in DOXYVAR_IGNORED[action]):
+                state = "got_descr"
+                break
+            i = j
 
-        else:
-            assert(False) # Unknown state
+        state = next_state
+        i += 1
 
     # check final state
     if(state != "got_descr"):
         # final state is not allowed
         raise SM_InvalidStateException('final', state, tag_content)
 
+    descr = tag_content[i:]
     if len(varlist)==1:
         return {varlist.pop().upper():descr}
     else:
         return {tuple(v.upper() for v in varlist):descr}
 
+#===============================================================================
+def doxyvar_error_context(tag_content, i):
+    """Highlight the offending char, only built when an error is raised"""
+    return(tag_content[:i] + "{" + tag_content[i] + "}" + tag_content[i+1:])
+
+#===============================================================================
+def find_closing_bracket(string, i):
+    """Return the index of the bracket closing the one opened at string[i],
+       -1 if it is never closed. Only brackets of the same kind are nested."""
+    opening = string[i]
+    closing = ")" if opening == "(" else "]"
+    n_opened = 0
+    for j in range(i, len(string)):
+        c = string[j]
+        if(c == opening):
+            n_opened += 1
+        elif(c == closing):
+            n_opened -= 1
+            if(n_opened == 0):
+                return(j)
+    return(-1)
+
 #===============================================================================
 def parse_use_statement(stream):
     line = stream.next_fortran_line()
@@ -995,7 +1523,7 @@ def parse_use_statement(stream):
         mod_from, rest = line[4:].split(",", 1)
         only = rest.split("ONLY:",1)[1].split(",")
         only_map = dict([tuple(x.split('=>',1)) if '=>' in x else (x,x) for x in only])
-        assert( all(re.match('\w+$',k) for k in only_map) )
+        assert( all(re.match(r'\w+$',k) for k in only_map) )
         ast = {'tag':'use_stm', 'from':mod_from, 'only':only_map}
     else:
         ast = {'tag':'use_stm', 'from':line[4:].strip()}
@@ -1013,25 +1541,152 @@ class BackwardEndOfFileException(Exception):
 #===============================================================================
 class SM_UnknownCharException(Exception):
     def __init__(self, c, state, string):
-        print 'SM_Error: char "%c" unknown for state "%s" [%s]' % (c, state, string)
+        print('SM_Error: char "%c" unknown for state "%s" [%s]' % (c, state, string))
 class SM_InvalidStateException(Exception):
     def __init__(self, spec, state, string):
-        print 'SM_Error: invalid %s state: "%s" [%s]' % (spec, state, string)
+        print('SM_Error: invalid %s state: "%s" [%s]' % (spec, state, string))
 
 #===============================================================================
 class ParserException(Exception):
     def __init__(self, line, locus):
-        print 'Strange line: "%s" [%s]' % (line, locus)
+        print('Strange line: "%s" [%s]' % (line, locus))
+
+#===============================================================================
+# used by InputStream.next_fortran_line()
+FORTRAN_SPECIAL_REGEX = re.compile("['\"!&;]")
+MULTI_BLANK_REGEX = re.compile(" {2,}")
+NONWORD_BLANK_REGEX = re.compile(" (?![A-Za-z])|(?<![A-Za-z]) ")
+
+#===============================================================================
+# CPP line markers: GNU cpp and gfortran -E write '# 12 "file.F" 1 3' (with
+#   optional flags), Intel's fpp and ifort -E may write '#line 12 "file.F"',
+#   the file name can be left out when it does not change.
+LINE_MARKER_REGEX = re.compile(r'[ \t]*#[ \t]*(?:line[ \t]+)?(\d+)(?:[ \t]+"(.*?)")?[ \t\d]*$', re.M)
 
 #===============================================================================
 class InputStream(object):
-    def __init__(self, filename):
-        cmd = ["cpp", "-nostdinc", "-traditional-cpp", "-D__parallel", filename]
-        self.buffer = check_output(cmd)
+    def __init__(self, filename, buffer=None):
+        """The stream is made of the given, already preprocessed, buffer.
+           If no buffer is given, it is obtained by preprocessing filename."""
+        if(buffer is None):
+            buffer = preprocess(filename)
+        elif(not LINE_MARKER_REGEX.match(buffer, re.match(r"\s*", buffer).end())):
+            # locus() relies on CPP line markers
+            buffer = '# 1 "%s"\n' % filename + buffer
+        if(not buffer.endswith("\n")):
+            buffer += "\n" # every line is read up to its newline
+        self.buffer = buffer
         self.filename = filename
         self.pos1 = -1
         self.pos2 = -1
         self._cpp_line_index, self._cpp_file_name, self._cpp_beg_pos1, self._cpp_cur_pos1, self._cpp_cur_pos2 = [None]*5
+        self._markers = None # cf. tell_at()
+        self._line_offsets, self._byte_offsets = None, None # cf. location()
+        self._file_offsets = {}
+        self.n_fortran_lines = 0 # logical lines consumed, each one once, peeks excluded
+        self._counted_to = -1    # where the last line counted begins
+
+    def dependencies(self):
+        """Return the names of the files the stream is made of, as recorded by
+           CPP's line markers, in order of first appearance: the input file
+           comes first, followed by the included ones."""
+        deps = []
+        for pos, line_index, fn in self.line_markers():
+            if(fn and not fn.startswith("<") and not fn in deps): # skip <built-in>, ...
+                deps.append(fn)
+        return(deps)
+
+    def line_markers(self):
+        """Return the (position, line index, file name) of the line markers,
+           the file name is carried over from the previous one if omitted"""
+        if(self._markers is None):
+            self._markers = []
+            file_name = self.filename
+            for m in re.finditer(r"^[ \t]*#.*", self.buffer, re.M):
+                marker = LINE_MARKER_REGEX.match(m.group(0))
+                if(marker): # other directives (e.g. #pragma) are left over
+                    file_name = marker.group(2) if marker.group(2) is not None else file_name
+                    self._markers.append( (m.start(), int(marker.group(1)), file_name) )
+        return(self._markers)
+
+    def reset_count(self):
+        """Count the logical lines consumed from the current position on"""
+        self.n_fortran_lines, self._counted_to = 0, self.pos2
+
+    def tell(self):
+        """Return the stream's state, to be restored via seek()"""
+        return((self.pos1, self.pos2, self._cpp_line_index, self._cpp_file_name,
+                self._cpp_beg_pos1, self._cpp_cur_pos1, self._cpp_cur_pos2))
+
+    def seek(self, state):
+        (self.pos1, self.pos2, self._cpp_line_index, self._cpp_file_name,
+         self._cpp_beg_pos1, self._cpp_cur_pos1, self._cpp_cur_pos2) = state
+
+    def tell_at(self, pos):
+        """Return the state the stream has right after reading the line that
+           ends just before pos (cf. tell())"""
+        markers = self.line_markers()
+        i = bisect(markers, (pos,)) - 1
+        if(i < 0):
+            cpp = (None, None, None)
+        else:
+            beg_pos1, line_index, file_name = markers[i]
+            cpp = (line_index, file_name, beg_pos1)
+        pos1 = self.buffer.rfind("\n", 0, pos-1) + 1
+        return((pos1, pos-1) + cpp + (None, None))
+
+    def location(self, beg, end):
+        """Return the location of the buffer's lines holding beg to end-1,
+           leading blank lines, CPP lines and comments other than doxygen
+           ones (!>) excluded:
+             file:           the file they come from (cf. line markers)
+             lines:          their first and last line numbers in that file
+             offsets:        byte offsets of their beginning and end in that
+                             file, None if it cannot be read (e.g. stdin)
+             buffer_lines:   the same as lines, within the buffer
+             buffer_offsets: the same as offsets, within the buffer
+           Lines are numbered from 1, end offsets are excluded. The trailing
+           lines coming from another file (e.g. an included one) are left
+           out of lines and offsets."""
+        if(self._line_offsets is None):
+            self._line_offsets = line_offsets(self.buffer)
+            self._byte_offsets = line_offsets(to_bytes(self.buffer))
+        starts = self._line_offsets
+        b1, b2 = bisect(starts, beg), bisect(starts, end - 1)
+        while(b1 < b2):
+            line = self.buffer[starts[b1-1] : starts[b1]].strip()
+            if(line[:1] not in ("", "#", "!") or line.startswith("!>")):
+                break
+            b1 += 1
+        file_name, l1 = self.file_line(b1)
+        e = b2
+        while(e > b1 and self.file_line(e)[0] != file_name):
+            e -= 1
+        l2 = self.file_line(e)[1]
+        offsets = self.file_offsets(file_name)
+        return({'file':file_name, 'lines':(l1, l2),
+                'offsets':(offsets[l1-1], offsets[l2]) if offsets and 0 < l1 <= l2 < len(offsets) else None,
+                'buffer_lines':(b1, b2), 'buffer_offsets':(self._byte_offsets[b1-1], self._byte_offsets[b2])})
+
+    def file_line(self, b):
+        """Return the file of buffer line b and its line number there"""
+        markers = self.line_markers()
+        i = bisect(markers, (self._line_offsets[b-1],)) - 1
+        if(i < 0):
+            return((self.filename, b))
+        pos, line_index, file_name = markers[i]
+        return((file_name, line_index + b - bisect(self._line_offsets, pos) - 1))
+
+    def file_offsets(self, file_name):
+        """Return the byte offsets of the lines of a file, None if it cannot be read"""
+        if(not file_name in self._file_offsets):
+            offsets = None
+            if(path.isfile(file_name)):
+                f = open(file_name, "rb")
+                offsets = line_offsets(f.read())
+                f.close()
+            self._file_offsets[file_name] = offsets
+        return(self._file_offsets[file_name])
 
     def next_raw_line(self):
         """Return next line including CPP-comments and advance stream's position"""
@@ -1063,10 +1718,14 @@ class InputStream(object):
             line_stripped = line.strip()
             if line_stripped.startswith("#"):
                 # preprocessor lines are used to get the info needed by locus()
-                line_index, file_name = line_stripped.split()[1:3]
-                self._cpp_line_index = int(line_index)
-                self._cpp_file_name  = file_name[1:-1]
-                self._cpp_beg_pos1   = self.pos1
+                marker = LINE_MARKER_REGEX.match(line_stripped)
+                if(marker):
+                    self._cpp_line_index = int(marker.group(1))
+                    if(marker.group(2) is not None):
+                        self._cpp_file_name = marker.group(2)
+                    elif(self._cpp_file_name is None):
+                        self._cpp_file_name = self.filename
+                    self._cpp_beg_pos1 = self.pos1
             elif line_stripped:
                 return(line)
 
@@ -1095,56 +1754,67 @@ class InputStream(object):
         """Return next logical fortran line and advance stream's position
            Any spaces are removed, except between words.
            Chars and chars are upper cased.
-           String are preserved."""
-        fortran_line = []
-        state = "start"
+           String are preserved.
+           Runs of plain text are normalized at once, only quotes, comments,
+           continuations and semicolons are dealt with one by one."""
+        fortran_line = []  # normalized pieces, none of them is empty
+        last = ""          # last char of fortran_line
+        blank = False      # blanks found after the last char of fortran_line
         line = self.next_line()
         pos1 = self.pos1 # save in case fortran line spans multiple raw line
-        i = -1 # current index within line
-        while(i+1 < len(line)):
-            i += 1; c = line[i]
-            if(state == "start"):
-                if(c == "'"):
-                    state = "str1"
-                    fortran_line.append(c)
-                elif(c == '"'):
-                    state = "str2"
-                    fortran_line.append(c)
-                elif(c == " "):
-                    if(fortran_line and fortran_line[-1].isalpha()): # remove double spaces
-                        fortran_line.append(c)
-                elif(c == "!"):
-                    if(len(fortran_line)==0):
-                        i, line = -1, self.next_line() # prefix comment lines
-                        pos1 = self.pos1
-                    else:
-                        break # fortran line ends here
-                elif(c == "&"):
-                    # skip prefix comment lines after ampersand
-                    while(self.peek_next_line().strip().startswith("!")):
-                        line = self.next_line()
-                    i, line = -1, self.next_line() # line continuation
-                    if(line.strip().startswith("&")):
-                        # next (continued) line could begin with another echoed ampersand
-                        line = line.replace("&"," ",1)
-                elif(c==";"):
-                    self.pos2 = self.pos1 + i
-                    break # end of fortran line
-                    #TODO: put some of the line back into stream
-                else:
-                    if(fortran_line and fortran_line[-1]==" " and not c.isalpha()):
-                        fortran_line.pop() # remove spaces except between words
-                    fortran_line.append(c.upper())
-
-            elif(state.startswith("str")):
-                fortran_line.append(c)
-                if((state=="str1" and c=="'") or (state=="str2" and c=='"')):
-                    state = "start"
-            else:
-                assert(False) # unkown state
+        i = 0 # current index within line
+        while(True):
+            m = FORTRAN_SPECIAL_REGEX.search(line, i)
+            j = m.start() if m else len(line)
+            if(j > i):
+                # the last char gives the context to decide whether leading blanks are kept
+                run = (last or ",") + (" " if blank else "") + line[i:j].upper()
+                stripped = run.rstrip(" ")
+                blank = len(stripped) < len(run)
+                if("  " in stripped):
+                    stripped = MULTI_BLANK_REGEX.sub(" ", stripped)
+                stripped = NONWORD_BLANK_REGEX.sub("", stripped) # remove spaces except between words
+                if(len(stripped) > 1):
+                    fortran_line.append(stripped[1:])
+                    last = stripped[-1]
+            if(not m):
+                break # fortran line ends here
+
+            c = line[j]
+            if(c == "'" or c == '"'):
+                if(blank and last and last in string.ascii_letters):
+                    fortran_line.append(" ")
+                blank = False
+                k = line.find(c, j+1)
+                if(k < 0):
+                    fortran_line.append(line[j:]) # unterminated string
+                    break
+                fortran_line.append(line[j:k+1])
+                last = c
+                i = k+1
+            elif(c == "!"):
+                if(fortran_line):
+                    break # fortran line ends here
+                i, line = 0, self.next_line() # prefix comment lines
+                pos1 = self.pos1
+            elif(c == "&"):
+                # skip prefix comment lines after ampersand
+                i, line = 0, self.next_line() # line continuation
+                while(line.lstrip().startswith("!")):
+                    line = self.next_line()
+                if(line.strip().startswith("&")):
+                    # next (continued) line could begin with another echoed ampersand
+                    line = line.replace("&"," ",1)
+            else: # c == ";"
+                self.pos2 = self.pos1 + j
+                break # end of fortran line
+                #TODO: put some of the line back into stream
 
         # needed to make prev_line() work properly
         self.pos1 = pos1
+        if(pos1 > self._counted_to): # not read before seeking back
+            self.n_fortran_lines += 1
+            self._counted_to = pos1
 
         # pos[12] saved here to make locus() give the right location when used
         #   after both peek_next_fortran_line() and next_fortran_line()
@@ -1154,9 +1824,10 @@ class InputStream(object):
 
     def peek_next_fortran_line(self, give_pos=False):
         """Peek at next fortran line"""
-        pos1, pos2 = self.pos1, self.pos2
+        pos1, pos2, counted = self.pos1, self.pos2, (self.n_fortran_lines, self._counted_to)
         line = self.next_fortran_line()
         self.pos1, self.pos2 = pos1, pos2
+        self.n_fortran_lines, self._counted_to = counted
         if( give_pos ): return (self._cpp_cur_pos1, line)
         return(line)
 
@@ -1167,14 +1838,181 @@ class InputStream(object):
         line_index = self.buffer[ self._cpp_beg_pos1 : self._cpp_cur_pos1 ].count('\n') + self._cpp_line_index -1
         return("%s:%d"%(fn,line_index))
 
+#===============================================================================
+def line_offsets(data):
+    """Return the offsets at which the lines of data (text or bytes) begin,
+       followed by the length of data"""
+    newline = "\n" if isinstance(data, str) else b"\n"
+    offsets = [0]
+    i = data.find(newline)
+    while(i >= 0):
+        offsets.append(i + 1)
+        i = data.find(newline, i + 1)
+    if(offsets[-1] != len(data)):
+        offsets.append(len(data))
+    return(offsets)
+
+
+#=============================================================================
+def preprocess(filename, source=None, defines=DEFAULT_DEFINES):
+    """Run CPP over filename. If the source text is given, it is piped into
+       CPP instead, filename being used for the line markers and to find
+       the included files."""
+    cmd = ["cpp", "-nostdinc", "-traditional-cpp"] + ["-D"+d for d in defines]
+    if(source is None):
+        return(check_output(cmd + [filename]))
+    if(path.dirname(filename)):
+        cmd += ["-I", path.dirname(filename)]
+    return(check_output(cmd + ["-"], input='# 1 "%s"\n' % filename + source))
+
+#=============================================================================
+# markers with flags, written by CPP when entering (1) or leaving (2) a file
+CPP_FLAGGED_MARKER_REGEX = re.compile(r'^# \d+ "[^"]*"((?: \d)+)$', re.M)
+CPP_MACRO_REGEX = re.compile(r'^[ \t]*#[ \t]*(?:define|undef)[ \t]+(\w+)', re.M)
+
+def preprocess_many(filenames, defines=DEFAULT_DEFINES):
+    """Run many files through a single CPP process, return the list of their
+       preprocessed texts. A stub fed to CPP includes them one after the
+       other, its output is split back at the line markers entering and
+       leaving each of them. After each file, the stub undefines the macros
+       it (un)defines and defines again those given, so that none leaks into
+       the next file (cf. defined_macros()). None is returned for the files
+       that have to be preprocessed on their own: those with a missing
+       include, or all of them if CPP fails."""
+    texts = [None] * len(filenames)
+    cache = {}
+    given = dict((d.split("=", 1) + ["1"])[:2] for d in defines)
+    batched, stub = [], []
+    for i, fn in enumerate(filenames):
+        macros = None if '"' in fn else defined_macros(fn, cache)
+        if(macros is None):
+            continue
+        batched.append(i)
+        stub.append('#include "%s"\n' % fn)
+        for name in sorted(macros):
+            stub.append("#undef %s\n" % name)
+            if(name in given):
+                stub.append("#define %s %s\n" % (name, given[name]))
+    if(not batched):
+        return(texts)
+    cmd = ["cpp", "-nostdinc", "-traditional-cpp"] + ["-D"+d for d in defines] + ["-"]
+    try:
+        output = check_output(cmd, input="".join(stub))
+    except subprocess.CalledProcessError:
+        return(texts) # it fails again on its own
+    chunks, depth, beg = [], 0, None
+    for m in CPP_FLAGGED_MARKER_REGEX.finditer(output):
+        flags = m.group(1).split()
+        if("1" in flags):
+            depth += 1
+            if(depth == 1):
+                beg = m.start() # entering one of the files
+        elif("2" in flags):
+            depth -= 1
+            if(depth == 0):
+                chunks.append(output[beg:m.start()]) # back into the stub
+    if(len(chunks) == len(batched)):
+        for i, text in zip(batched, chunks):
+            texts[i] = text
+    return(texts)
+
+def defined_macros(filename, cache):
+    """Return the set of the macros a file, or one it includes, defines or
+       undefines, None if one of its includes is missing"""
+    macros = set()
+    for fn, text in include_closure(filename, cache=cache):
+        if(text is None):
+            return(None)
+        macros.update(CPP_MACRO_REGEX.findall(text))
+    return(macros)
+
+#=============================================================================
+CPP_INCLUDE_REGEX = re.compile(r'^[ \t]*#[ \t]*include[ \t]*"([^"]*)"', re.M)
+
+def include_closure(filename, include_dirs=(), cache=None):
+    """Return the list of (filename, text) of a file and of those it includes
+       through quoted #include directives, recursively, each once. An include
+       is looked for next to the including file first, as CPP does, then in
+       include_dirs. One not found is listed with None as its text."""
+    if(cache is None):
+        cache = {}
+    closure, seen, todo = [], set(), [filename]
+    while(todo):
+        fn = todo.pop(0)
+        if(fn in seen):
+            continue
+        seen.add(fn)
+        if(not fn in cache):
+            cache[fn] = (None, [])
+            if(path.isfile(fn)):
+                f = open(fn, "rb")
+                text = to_text(f.read())
+                f.close()
+                includes = [find_include(name, fn, include_dirs) for name in CPP_INCLUDE_REGEX.findall(text)]
+                cache[fn] = (text, includes)
+        text, includes = cache[fn]
+        closure.append((fn, text))
+        todo.extend(includes)
+    return(closure)
+
+def find_include(name, including, include_dirs=()):
+    """Return the path of a quoted include, the name itself if not found"""
+    for d in [path.dirname(including)] + list(include_dirs):
+        fn = path.join(d, name)
+        if(path.isfile(fn)):
+            return(fn)
+    return(name)
+
+#=============================================================================
+MMAP_THRESHOLD = 1 << 20
+
+def read_source(filename):
+    """Return the text of a file, "-" being stdin. Large files are mapped
+       into memory: on Python 3 they get decoded straight from the mapped
+       pages, without an intermediate copy."""
+    if(filename == "-"):
+        return(to_text(getattr(sys.stdin, "buffer", sys.stdin).read()))
+    f = open(filename, "rb")
+    try:
+        if(os.fstat(f.fileno()).st_size < MMAP_THRESHOLD):
+            return(to_text(f.read()))
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if(str is bytes):
+                return(m[:]) # Python 2
+            return(str(m, "utf-8", "surrogateescape"))
+        finally:
+            m.close()
+    finally:
+        f.close()
 
 #=============================================================================
 def check_output(*popenargs, **kwargs):
-    """ backport for Python 2.4 """
+    """ backport for Python 2.4, taking and returning text """
+    input = kwargs.pop('input', None)
+    if(input is not None):
+        kwargs['stdin'] = subprocess.PIPE
+        input = to_bytes(input)
     p = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-    output = p.communicate()[0]
-    assert(p.wait() == 0)
-    return output
+    output = p.communicate(input)[0]
+    if(p.wait() != 0):
+        raise subprocess.CalledProcessError(p.returncode, popenargs[0]) # as subprocess.check_output()
+    return to_text(output)
+
+#=============================================================================
+# On Python 2 text is bytes (str) already. On Python 3 the sources are taken
+#   as UTF-8, undecodable bytes (e.g. Latin-1 comments) being carried through
+#   as surrogates: encoding the text back yields the original bytes, hence the
+#   same hashes on both.
+def to_text(data):
+    if(isinstance(data, str)):
+        return(data)
+    return(data.decode("utf-8", "surrogateescape"))
+
+def to_bytes(text):
+    if(isinstance(text, bytes)):
+        return(text)
+    return(text.encode("utf-8", "surrogateescape"))
 
 #===============================================================================
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Report the changes of the public API between two snapshots of a tree
+
+A snapshot is given either as an archive (fparse_archive.py, or merge
+--archive) or as an index {module name: .ast file} (fparse_batch.py run
+--index, or merge): the ASTs cached by previous runs are reused, nothing
+is parsed again. The serialized texts of each module are compared first,
+only the modules whose texts differ get decoded and compared.
+
+The public API of a module is made of its PUBLIC routines (their arguments
+with type, intent, other attributes and dimensions, and the return value of
+functions), types (their members), generic interfaces and variables, be
+they listed in PUBLIC statements or public by default. The
+report maps each changed module to the entities added, removed or changed.
+The exit status is 1 if anything was removed or changed, as for diff."""
+
+import sys
+from os import path
+
+from fparse import format_ast, eval_ast, to_bytes
+from fparse_archive import MAGIC, ArchiveReader
+
+#===============================================================================
+def main():
+    if(not len(sys.argv) in (3, 4)):
+        print("Usage: fparse_apidiff.py <old.astar|old index> <new.astar|new index> [<output.report>]")
+        sys.exit(1)
+
+    old, new = open_snapshot(sys.argv[1]), open_snapshot(sys.argv[2])
+    report = api_diff(old, new)
+    old.close()
+    new.close()
+
+    if(len(sys.argv) == 4):
+        f = open(sys.argv[3], "w")
+        f.write(format_ast(report) + "\n")
+        f.close()
+        print("Wrote: "+sys.argv[3])
+    print_summary(report)
+    sys.exit(1 if report['changed'] or report['removed'] else 0)
+
+#===============================================================================
+def open_snapshot(fn):
+    """Return an archive or an index as a snapshot"""
+    f = open(fn, "rb")
+    is_archive = f.read(len(MAGIC)) == to_bytes(MAGIC)
+    f.close()
+    return(ArchiveReader(fn) if is_archive else IndexSnapshot(fn))
+
+#===============================================================================
+class IndexSnapshot(object):
+    """The .ast files listed by an index, with the interface of ArchiveReader"""
+    def __init__(self, filename):
+        f = open(filename)
+        self.index = eval_ast(f.read())
+        f.close()
+        self.root = path.dirname(path.abspath(filename))
+
+    def names(self):
+        return(sorted(self.index))
+
+    def get_text(self, name):
+        f = open(path.join(self.root, self.index[name]))
+        text = f.read()
+        f.close()
+        return(text.rstrip("\n"))
+
+    def get(self, name):
+        return(eval_ast(self.get_text(name)))
+
+    def __contains__(self, name):
+        return(name in self.index)
+
+    def close(self):
+        pass
+
+#===============================================================================
+def api_diff(old, new):
+    """Compare the public API of two snapshots, return the report:
+       {'added': [modules], 'removed': [modules], 'changed': {module: changes},
+        'unchanged': number of modules with an identical text,
+        'compared': number of modules decoded and compared}"""
+    report = {'added':[], 'removed':[], 'changed':{}, 'unchanged':0, 'compared':0}
+    for name in old.names():
+        if(not name in new):
+            report['removed'].append(name)
+    for name in new.names():
+        if(not name in old):
+            report['added'].append(name)
+            continue
+        text_old, text_new = old.get_text(name), new.get_text(name)
+        if(text_old == text_new):
+            report['unchanged'] += 1
+            continue
+        report['compared'] += 1
+        changes = diff_module(get_api(eval_ast(text_old)), get_api(eval_ast(text_new)))
+        if(changes):
+            report['changed'][name] = changes
+    return(report)
+
+#===============================================================================
+def get_api(mod):
+    """Return the public API of a module AST: {(kind, name): signature}"""
+    publics = set(p['name'] for p in mod['publics'])
+    privates = set(p['name'] for p in mod.get('privates', []))
+    default_public = mod.get('visibility', 'PUBLIC') == 'PUBLIC'
+    is_public = lambda name: name in publics or (default_public and not name in privates)
+    api = {}
+    for r in mod['subroutines'] + mod['functions']:
+        if(is_public(r['name'])):
+            sig = {'args':[arg_signature(a) for a in r['args']]}
+            if(r['retval']):
+                sig['retval'] = arg_signature(r['retval'])
+            api[(r['tag'], r['name'])] = sig
+    for t in mod['types']:
+        if(is_public(t['name'])):
+            api[('type', t['name'])] = {'members':[arg_signature(v) for v in t['variables']]}
+    for i in mod['interfaces']:
+        if(i['name'] and is_public(i['name'])):
+            procs = [p if isinstance(p, str) else p['name'] for p in i['procedures']]
+            api[('interface', i['name'])] = {'procedures':sorted(procs)}
+    for v in mod['variables']:
+        if(v['visibility'] == 'PUBLIC'):
+            api[('variable', v['name'])] = arg_signature(v)
+    return(api)
+
+def arg_signature(a):
+    # the intent is split out, the dimensions are in 'dim' already
+    attrs = [x for x in a.get('attrs', []) if not x.startswith("INTENT(") and not x.startswith("DIMENSION(")]
+    intents = [x[7:-1] for x in a.get('attrs', []) if x.startswith("INTENT(")]
+    return({'name':a['name'], 'type':a.get('type'), 'intent':intents[0] if intents else None,
+            'attrs':sorted(attrs), 'dim':a.get('dim', '')})
+
+#===============================================================================
+def diff_module(old, new):
+    """Return {'added': [...], 'removed': [...], 'changed': {entity: [changes]}},
+       None if the APIs are the same. Entities are named "kind NAME"."""
+    entity = lambda key: "%s %s" % key
+    changes = {'added':sorted(entity(k) for k in new if not k in old),
+               'removed':sorted(entity(k) for k in old if not k in new),
+               'changed':{}}
+    for k in sorted(set(old) & set(new)):
+        if(old[k] != new[k]):
+            changes['changed'][entity(k)] = describe_changes(old[k], new[k])
+    if(not (changes['added'] or changes['removed'] or changes['changed'])):
+        return(None)
+    return(changes)
+
+def describe_changes(old, new):
+    """Return a list of readable changes between two signatures"""
+    if('name' in old): # a variable
+        return(describe_decl("", old, new))
+    out = []
+    for what in ('args', 'members'):
+        if(what in old):
+            a, b = old[what], new[what]
+            label = "argument" if what == 'args' else "member"
+            names_a, names_b = [x['name'] for x in a], [x['name'] for x in b]
+            for n in names_a:
+                if(not n in names_b):
+                    out.append("%s %s removed" % (label, n))
+            for n in names_b:
+                if(not n in names_a):
+                    out.append("%s %s added" % (label, n))
+            common = [n for n in names_a if n in names_b]
+            if(common != [n for n in names_b if n in names_a]):
+                out.append("%ss reordered: (%s) -> (%s)" % (label, ", ".join(names_a), ", ".join(names_b)))
+            for n in common:
+                out += describe_decl("%s %s: " % (label, n), a[names_a.index(n)], b[names_b.index(n)])
+    if(old.get('retval') != new.get('retval')):
+        if(old.get('retval') and new.get('retval')):
+            out += describe_decl("return value: ", old['retval'], new['retval'])
+        else:
+            out.append("return value %s" % ("added" if new.get('retval') else "removed"))
+    if(old.get('procedures') != new.get('procedures')):
+        out.append("procedures: %s -> %s" % (", ".join(old['procedures']), ", ".join(new['procedures'])))
+    return(out)
+
+def describe_decl(prefix, a, b):
+    out = []
+    for k in ('name', 'type', 'intent', 'attrs', 'dim'):
+        if(a[k] != b[k]):
+            show = lambda v: ", ".join(v) if isinstance(v, list) else str(v)
+            out.append("%s%s %s -> %s" % (prefix, k, show(a[k]), show(b[k])))
+    return(out)
+
+#===============================================================================
+def print_summary(report):
+    print("Modules: %d unchanged, %d compared, %d with API changes, %d added, %d removed"
+          % (report['unchanged'], report['compared'], len(report['changed']),
+             len(report['added']), len(report['removed'])))
+    for name in report['removed']:
+        print("- module %s" % name)
+    for name in report['added']:
+        print("+ module %s" % name)
+    for name in sorted(report['changed']):
+        changes = report['changed'][name]
+        print("~ module %s" % name)
+        for e in changes['removed']:
+            print("    - %s" % e)
+        for e in changes['added']:
+            print("    + %s" % e)
+        for e in sorted(changes['changed']):
+            print("    ~ %s: %s" % (e, "; ".join(changes['changed'][e])))
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF
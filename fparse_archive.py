@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Single-file archive of module ASTs with random access
+
+Layout of an archive:
+    FPARSE-ARCHIVE 1 <index offset, 16 digits>\\n
+    <AST of 1st module, as written by fparse.py>\\n
+    <AST of 2nd module>\\n
+    ...
+    <index: {module name: (offset, length)}>\\n
+
+The archive is read through mmap: fetching one module only decodes its own
+slice, while iterating over all the modules is one sequential read."""
+
+import sys
+import mmap
+
+from fparse import format_ast, eval_ast, to_bytes, to_text
+
+MAGIC = "FPARSE-ARCHIVE 1 "
+HEADER_LEN = len(MAGIC) + 16 + 1
+
+#===============================================================================
+def main():
+    usage = ("Usage: fparse_archive.py pack <output.astar> <input.ast> ...\n"
+             "       fparse_archive.py list <input.astar>\n"
+             "       fparse_archive.py get <input.astar> <module> [<output.ast>]")
+    if(len(sys.argv) < 3 or not sys.argv[1] in ("pack", "list", "get")):
+        print(usage)
+        sys.exit(1)
+
+    cmd, fn_archive, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if(cmd == "pack"):
+        write_archive(fn_archive, (read_ast(fn) for fn in args))
+        print("Wrote: "+fn_archive)
+    elif(cmd == "list"):
+        archive = ArchiveReader(fn_archive)
+        for name in archive.names():
+            print(name)
+        archive.close()
+    elif(cmd == "get"):
+        if(not len(args) in (1, 2)):
+            print(usage)
+            sys.exit(1)
+        archive = ArchiveReader(fn_archive)
+        text = archive.get_text(args[0].upper())
+        archive.close()
+        if(len(args) == 2):
+            f = open(args[1], "w")
+            f.write(text + "\n")
+            f.close()
+            print("Wrote: "+args[1])
+        else:
+            print(text)
+
+#===============================================================================
+def read_ast(fn):
+    f = open(fn)
+    ast = eval_ast(f.read())
+    f.close()
+    return(ast)
+
+#===============================================================================
+def write_archive(fn, asts):
+    """Write the module ASTs into a new archive"""
+    f = open(fn, "wb")
+    f.write(to_bytes(MAGIC + "0"*16 + "\n"))  # the index offset is known only at the end
+    index = {}
+    for ast in asts:
+        assert(ast['tag'] == 'module')
+        assert(not ast['name'] in index) # module names must be unique
+        data = to_bytes(format_ast(ast) + "\n")
+        index[ast['name']] = (f.tell(), len(data) - 1) # offsets and lengths are in bytes
+        f.write(data)
+    index_at = f.tell()
+    f.write(to_bytes(format_ast(index) + "\n"))
+    f.seek(0)
+    f.write(to_bytes(MAGIC + "%016d" % index_at + "\n"))
+    f.close()
+
+#===============================================================================
+class ArchiveReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = to_text(self._map[:HEADER_LEN])
+        if(not header.startswith(MAGIC)):
+            raise Exception('not an fparse archive: "%s"' % filename)
+        index_at = int(header[len(MAGIC):])
+        self.index = eval_ast(to_text(self._map[index_at:]))
+
+    def names(self):
+        """Return the module names, in archive order"""
+        return(sorted(self.index, key=lambda name: self.index[name][0]))
+
+    def get_text(self, name):
+        """Return the serialized AST of module name"""
+        offset, length = self.index[name]
+        return(to_text(self._map[offset : offset+length]))
+
+    def get(self, name):
+        """Return the AST of module name, only its slice gets decoded"""
+        return(eval_ast(self.get_text(name)))
+
+    def __contains__(self, name):
+        return(name in self.index)
+
+    def __iter__(self):
+        """Yield all the module ASTs, reading the archive sequentially"""
+        for name in self.names():
+            yield self.get(name)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF
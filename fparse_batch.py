@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Batch parsing of a whole tree
+
+The run command parses the files one after the other within one process:
+each AST is written out as soon as it is complete and then dropped, along
+with the preprocessed buffer, so that memory use stays flat whatever the
+size of the tree.
+
+The other commands implement cooperative parsing through a shared work-queue
+directory. The queue directory (e.g. on an NFS workspace) is shared by all the workers,
+which can run on any host:
+    <queue>/todo/<id>                  files still to be parsed
+    <queue>/claimed/<id>@<host>@<pid>  files being parsed by a worker
+    <queue>/done/<id>                  files parsed successfully
+    <queue>/failed/<id>                files the parser choked on
+    <queue>/tmp/                       entries being written
+Each entry is a small dict: {'src': input file, 'out': output .ast file}.
+
+A worker claims an entry by renaming it from todo/ to claimed/: the rename
+is atomic, so only one worker wins. Outputs are written to a temporary file
+and renamed into place, so they are never seen half written. The claims of
+crashed workers become stale (dead process on this host, or not touched for
+a while) and are moved back to todo/. A file can thus happen to be parsed
+twice, never lost. Once the queue is drained, merge builds the final index.
+
+With --profile, run records for each file its wall time, peak traced
+allocation (tracemalloc, Python 3 only), preprocessed buffer size, logical
+line count and AST node count. The wall time is measured with the
+allocations being traced, when they are (cf. the traced field): it is
+inflated several fold, what matters is the ranking. The report (.csv or
+.json) lists the files worst first, ranked by time and by memory.
+
+The run command appends each completed file to <outdir>/fparse.journal,
+along with the hashes of its input files (the included ones too) and of its
+output. With --resume, an interrupted run skips the files journaled as
+complete whose inputs are unchanged and whose output is intact; anything
+else, e.g. an output cut short by the crash, is parsed again.
+
+With --root MODULE, run parses only the modules reachable from the root
+ones through USE statements. The closure is found by reading nothing but
+the MODULE and USE lines of each file and of the files it includes
+(cf. scan_uses()).
+
+With --cpp-batch N, run preprocesses the files N at a time through a single
+cpp process (cf. fparse.preprocess_many()) instead of one cpp per file.
+
+The work command supervises its -j worker processes. A worker spending more
+than --time-limit seconds or --memory-limit MB (resident) on one file, e.g.
+spinning over a malformed one, is killed and replaced: the file goes to
+failed/ with the reason as its error. With --max-files N, each worker is
+replaced after N files, which bounds the memory it can accumulate.
+
+    fparse_batch.py run <outdir> <file.F|dir> ...
+    fparse_batch.py enqueue <queue> <outdir> <file.F|dir> ...
+    fparse_batch.py work <queue> [-j N]
+    fparse_batch.py merge <queue> <index>"""
+
+import sys
+import os
+import time
+import errno
+import random
+import socket
+import signal
+import traceback
+import multiprocessing
+import csv
+import json
+import hashlib
+import re
+from os import path
+from pprint import pformat
+from ast import literal_eval
+from optparse import OptionParser
+
+import fparse
+from fparse_archive import write_archive, read_ast
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2: no peak memory in the profile
+
+QUEUE_DIRS = ("todo", "claimed", "done", "failed", "tmp")
+POLL_INTERVAL = 1.0 # seconds between two checks of the workers' limits
+JOURNAL = "fparse.journal"
+
+# Preprocessor conditionals are not evaluated: the USE statements of every
+#   branch are followed, which can only make the closure larger.
+MODULE_LINE_REGEX = re.compile(r"^[ \t]*MODULE[ \t]+(?!PROCEDURE\b)(\w+)", re.I | re.M)
+USE_LINE_REGEX = re.compile(r"^[ \t]*USE\b(?:[ \t]*,[ \t]*(?:NON_)?INTRINSIC)?[ \t]*(?:::)?[ \t]*(\w+)", re.I | re.M)
+PROFILE_FIELDS = ("file", "module", "status", "wall_time", "traced", "peak_memory", "buffer_size",
+                  "fortran_lines", "ast_nodes", "time_rank", "memory_rank")
+
+#===============================================================================
+def main():
+    parser = option_parser()
+    options, args = parser.parse_args()
+
+    if(len(args) < 2):
+        parser.print_usage()
+        sys.exit(1)
+    cmd, args = args[0], args[1:]
+
+    if(cmd == "run" and len(args) >= 2):
+        n_failed = run(args[0], args[1:], options)
+        sys.exit(1 if n_failed else 0)
+    elif(cmd == "enqueue" and len(args) >= 3):
+        n = enqueue(args[0], args[1], args[2:])
+        print("Enqueued: %d files" % n)
+    elif(cmd == "work" and len(args) == 1):
+        ok = supervise(args[0], options)
+        sys.exit(0 if ok else 1)
+    elif(cmd == "merge" and len(args) == 2):
+        ok = merge(args[0], args[1], options.archive, options.partial)
+        sys.exit(0 if ok else 1)
+    else:
+        parser.print_usage()
+        sys.exit(1)
+
+#===============================================================================
+def option_parser():
+    parser = OptionParser(usage=__doc__.rsplit("\n\n",1)[1])
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="[work] number of local worker processes")
+    parser.add_option("--stale", metavar="SECONDS", type="int", default=1800,
+                      help="[work] claims not touched for this long are taken over")
+    parser.add_option("--wait", action="store_true", default=False,
+                      help="[work] do not quit while other workers hold claims")
+    parser.add_option("--time-limit", metavar="SECONDS", type="float", default=0,
+                      help="[work] kill a worker spending longer on one file")
+    parser.add_option("--memory-limit", metavar="MB", type="float", default=0,
+                      help="[work] kill a worker growing larger on one file (needs /proc)")
+    parser.add_option("--max-files", metavar="N", type="int", default=0,
+                      help="[work] replace each worker after N files")
+    parser.add_option("--callgraph", action="store_true", default=False,
+                      help="[run, work] record the routines called by each routine")
+    parser.add_option("--depfile", action="store_true", default=False,
+                      help="[run, work] write a dependency file next to each .ast")
+    parser.add_option("--locations", action="store_true", default=False,
+                      help="[run] record where each module, type, routine, interface and variable is")
+    parser.add_option("--index", metavar="FILE",
+                      help="[run] write the index of the parsed modules")
+    parser.add_option("--root", metavar="MODULE", action="append", default=[],
+                      help="[run] parse only the modules reachable from this one (repeatable)")
+    parser.add_option("--cpp-batch", metavar="N", type="int", default=0,
+                      help="[run] preprocess N files per cpp process")
+    parser.add_option("--resume", action="store_true", default=False,
+                      help="[run] skip the files completed by a previous run")
+    parser.add_option("--profile", metavar="FILE",
+                      help="[run] write the per-file profile, as .csv or .json")
+    parser.add_option("--archive", metavar="FILE",
+                      help="[merge] also pack all the ASTs into an archive")
+    parser.add_option("--partial", action="store_true", default=False,
+                      help="[merge] do not require the queue to be drained")
+    return(parser)
+
+#===============================================================================
+def enqueue(queue, outdir, sources):
+    """Add an entry to the queue for each source file (directories are
+       searched for .F files). Outputs mirror the layout of the directories."""
+    for d in QUEUE_DIRS:
+        if(not path.isdir(path.join(queue, d))):
+            os.makedirs(path.join(queue, d))
+
+    n0 = next_entry_number(queue)
+    n = 0
+    for src, out in list_jobs(outdir, sources):
+        entry = {'src':path.abspath(src), 'out':path.abspath(out)}
+        entry_id = "%06d_%s" % (n0+n, path.basename(src))
+        write_atomic(path.join(queue, "todo", entry_id), pformat(entry)+"\n", path.join(queue, "tmp"))
+        n += 1
+    return(n)
+
+def next_entry_number(queue):
+    """Return the number following the largest one among the entries of the
+       queue, wherever they are, so that no entry id is ever reused"""
+    numbers = [int(fn.split("_", 1)[0]) for d in ("todo", "claimed", "done", "failed")
+               for fn in os.listdir(path.join(queue, d)) if fn.split("_", 1)[0].isdigit()]
+    return(max(numbers) + 1 if numbers else 0)
+
+#===============================================================================
+def list_jobs(outdir, sources):
+    """Yield a (source file, output file) tuple for each source file,
+       directories are searched for .F files and their layout is mirrored"""
+    for s in sources:
+        if(path.isdir(s)):
+            for root, dirs, fns in os.walk(s):
+                dirs.sort()
+                for fn in sorted(fns):
+                    if(fn.endswith(".F")):
+                        src = path.join(root, fn)
+                        yield (src, path.join(outdir, path.splitext(path.relpath(src, s))[0]+".ast"))
+        else:
+            yield (s, path.join(outdir, path.splitext(path.basename(s))[0]+".ast"))
+
+#===============================================================================
+def reachable_jobs(jobs, roots, include_dirs=()):
+    """Return the jobs of the modules reachable from the root ones"""
+    jobs = list(jobs)
+    by_module, uses, cache = {}, {}, {}
+    for src, out in jobs:
+        name, used = scan_uses(src, include_dirs, cache)
+        if(name):
+            by_module[name] = (src, out)
+            uses[name] = used
+    todo = [r.upper() for r in roots]
+    for r in todo:
+        if(not r in by_module):
+            raise Exception('root module not found: "%s"' % r)
+    reached = set(todo)
+    while(todo):
+        for name in uses[todo.pop()]:
+            if(name in by_module and not name in reached): # intrinsic or external otherwise
+                reached.add(name)
+                todo.append(name)
+    print("Reachable: %d of %d files" % (len(reached), len(jobs)))
+    selected = set(by_module[name] for name in reached)
+    return([job for job in jobs if job in selected]) # in the order of the tree
+
+#===============================================================================
+def scan_uses(fn, include_dirs=(), cache=None):
+    """Return the name of the module in file fn and the set of the modules it
+       uses, from the raw text: no preprocessing, no parsing. The USE lines
+       of the routines are included, as are those of the files it includes
+       (cf. fparse.include_closure())."""
+    closure = fparse.include_closure(fn, include_dirs, cache)
+    m = MODULE_LINE_REGEX.search(closure[0][1] or "")
+    if(not m):
+        return(None, set())
+    used = set()
+    for included, text in closure:
+        used.update(u.upper() for u in USE_LINE_REGEX.findall(text or ""))
+    return(m.group(1).upper(), used)
+
+#===============================================================================
+def run(outdir, sources, options):
+    """Parse the source files one at a time, return the number of failures"""
+    index, n_failed, n_resumed = {}, 0, 0
+    profiler = Profiler() if options.profile else None
+    parser = fparse.Parser(callgraph=options.callgraph, cache_size=0,
+                           hooks=[profiler] if profiler else [], locations=options.locations)
+    settings = {'callgraph':options.callgraph, 'depfile':options.depfile}
+    if(options.locations):
+        settings['locations'] = True # journals written before the option stay valid
+    fn_journal = path.join(outdir, JOURNAL)
+    completed = read_journal(fn_journal) if options.resume else {}
+    if(not path.isdir(outdir)):
+        os.makedirs(outdir)
+    journal = open(fn_journal, "a" if options.resume else "w")
+    if(options.resume):
+        journal.write("\n") # terminates a line cut short by a crash, blank lines are skipped
+    jobs = list_jobs(outdir, sources)
+    if(options.root):
+        jobs = reachable_jobs(jobs, options.root)
+    pending = []
+    for src, out in jobs:
+        entry = completed.get(path.abspath(src))
+        if(entry and entry['settings'] == settings and is_intact(entry, out)):
+            index[entry['module']] = path.relpath(out, outdir)
+            n_resumed += 1
+        else:
+            pending.append((src, out))
+
+    texts = {} # preprocessed ahead by batches, only one batch is held at a time
+    for k, (src, out) in enumerate(pending):
+        if(options.cpp_batch and k % options.cpp_batch == 0):
+            batch = [s for s, o in pending[k : k+options.cpp_batch]]
+            texts = dict(zip(batch, fparse.preprocess_many(batch, parser.defines)))
+        if(profiler):
+            profiler.start(src)
+        try:
+            deps = []
+            name = parse_one(src, out, depfile=options.depfile, parser=parser, deps=deps, text=texts.pop(src, None))
+            index[name] = path.relpath(out, outdir)
+            append_journal(journal, {'src':path.abspath(src), 'out':path.abspath(out), 'module':name,
+                                     'settings':settings, 'output':file_hash(out),
+                                     'inputs':dict((path.abspath(fn), file_hash(fn)) for fn in deps)})
+        except Exception:
+            name = None
+            n_failed += 1
+            sys.stderr.write("Failed: %s\n%s" % (src, traceback.format_exc()))
+            if(hasattr(sys, "exc_clear")):
+                sys.exc_clear() # the traceback's frames would keep the stream alive
+        if(profiler):
+            profiler.stop(name)
+    journal.close()
+    if(n_resumed):
+        print("Resumed: %d files already complete" % n_resumed)
+    print("Parsed: %d files, %d failed" % (len(index)+n_failed-n_resumed, n_failed))
+
+    if(profiler):
+        profiler.write(options.profile)
+        print("Wrote: %s" % options.profile)
+        profiler.summary()
+
+    if(options.index):
+        root = path.dirname(path.abspath(options.index))
+        index = dict((name, path.relpath(path.join(outdir, rel), root)) for name, rel in index.items())
+        f = open(options.index, "w")
+        f.write(fparse.format_ast(index) + "\n")
+        f.close()
+        print("Wrote: %s (%d modules)" % (options.index, len(index)))
+    return(n_failed)
+
+#===============================================================================
+def work(queue, options):
+    """Parse queued files until there is nothing left to claim"""
+    worker = "%s@%d" % (socket.gethostname(), os.getpid())
+    n_done, n_failed = 0, 0
+    while(not options.max_files or n_done + n_failed < options.max_files):
+        reclaim_stale(queue, options.stale)
+        todo = os.listdir(path.join(queue, "todo"))
+        if(not todo):
+            if(options.wait and os.listdir(path.join(queue, "claimed"))):
+                time.sleep(5)
+                continue
+            break
+        random.shuffle(todo) # spread the workers over the queue
+        for entry_id in todo:
+            claim = path.join(queue, "claimed", entry_id + "@" + worker)
+            try:
+                os.rename(path.join(queue, "todo", entry_id), claim)
+                os.utime(claim, None) # the claim is fresh: it is not stale
+            except OSError:
+                continue # somebody else got it (or took it over) first
+            entry = read_entry(claim)
+            try:
+                entry['module'] = parse_one(entry['src'], entry['out'], options.callgraph, options.depfile)
+            except Exception:
+                entry['error'] = traceback.format_exc()
+                finish(queue, claim, path.join(queue, "failed", entry_id), entry)
+                n_failed += 1
+            else:
+                finish(queue, claim, path.join(queue, "done", entry_id), entry)
+                n_done += 1
+            if(options.max_files and n_done + n_failed >= options.max_files):
+                break # retire, a fresh worker takes over
+
+    print("Worker %s: parsed %d files, %d failed" % (worker, n_done, n_failed))
+    if(n_failed):
+        sys.exit(1)
+
+#===============================================================================
+def supervise(queue, options):
+    """Keep options.jobs worker processes running while there is work left,
+       kill and replace those exceeding the per-file limits.
+       Return False if a file failed or a worker had to be killed."""
+    slots = [None] * options.jobs
+    ok = True
+    while(True):
+        for i, p in enumerate(slots):
+            if(p is not None and not p.is_alive()):
+                p.join()
+                ok = ok and p.exitcode == 0
+                slots[i] = None
+            if(slots[i] is None and has_work(queue, options)):
+                slots[i] = multiprocessing.Process(target=work, args=(queue, options))
+                slots[i].start()
+        if(all(p is None for p in slots)):
+            return(ok)
+        if(options.time_limit or options.memory_limit):
+            ok = enforce_limits(queue, options, [p for p in slots if p]) and ok
+        time.sleep(POLL_INTERVAL)
+
+#===============================================================================
+def has_work(queue, options):
+    if(os.listdir(path.join(queue, "todo"))):
+        return(True)
+    return(options.wait and bool(os.listdir(path.join(queue, "claimed"))))
+
+#===============================================================================
+def enforce_limits(queue, options, workers):
+    """Kill the workers whose current file exceeds the limits (its claim's
+       age tells how long they have been at it), return False if any"""
+    host = socket.gethostname()
+    by_pid = dict((p.pid, p) for p in workers)
+    now = time.time()
+    ok = True
+    for claim in os.listdir(path.join(queue, "claimed")):
+        entry_id, claim_host, claim_pid = claim.rsplit("@", 2)
+        p = by_pid.get(int(claim_pid)) if claim_host == host else None
+        if(p is None):
+            continue # not one of ours
+        try:
+            elapsed = now - os.stat(path.join(queue, "claimed", claim)).st_mtime
+        except OSError:
+            continue # finished meanwhile
+        reason = None
+        if(options.time_limit and elapsed > options.time_limit):
+            reason = "wall time limit of %g s exceeded" % options.time_limit
+        elif(options.memory_limit):
+            rss = resident_memory(p.pid)
+            if(rss is not None and rss > options.memory_limit):
+                reason = "memory limit of %g MB exceeded (%.0f MB resident)" % (options.memory_limit, rss)
+        if(reason):
+            kill_worker(queue, p, claim, entry_id, reason)
+            ok = False
+    return(ok)
+
+#===============================================================================
+def kill_worker(queue, p, claim, entry_id, reason):
+    """Kill worker p and move its claim to failed/, with reason as the error"""
+    # take the claim over first: the dead worker's claim would be moved back
+    #   to todo/ by reclaim_stale(), and the file be retried forever
+    taken = path.join(queue, "claimed", "%s@%s@%d" % (entry_id, socket.gethostname(), os.getpid()))
+    try:
+        os.rename(path.join(queue, "claimed", claim), taken)
+    except OSError:
+        return # the worker was done with it meanwhile
+    os.kill(p.pid, signal.SIGKILL)
+    p.join()
+    if(path.exists(path.join(queue, "done", entry_id))):
+        os.remove(taken) # it completed just before being killed
+        return
+    entry = read_entry(taken)
+    entry['error'] = "Killed: %s" % reason
+    finish(queue, taken, path.join(queue, "failed", entry_id), entry)
+    sys.stderr.write("Killed worker %d: %s (%s)\n" % (p.pid, entry['src'], reason))
+
+#===============================================================================
+def resident_memory(pid):
+    """Resident memory of process pid in MB, None without /proc"""
+    try:
+        f = open("/proc/%d/statm" % pid)
+        pages = int(f.read().split()[1])
+        f.close()
+    except (IOError, OSError):
+        return(None)
+    return(pages * os.sysconf("SC_PAGE_SIZE") / 1048576.0)
+
+#===============================================================================
+def parse_one(src, out, callgraph=False, depfile=False, parser=None, deps=None, text=None):
+    """Parse file src into out, return the module name.
+       Nothing but the name survives: the AST is serialized right away.
+       If an fparse.Parser is given, it is used (and callgraph is ignored),
+       along with the already preprocessed text of src if given.
+       If a deps list is given, it is extended with the input files."""
+    if(deps is None):
+        deps = []
+    if(parser and text is not None):
+        ast = parser.parse_string(text, src, deps)
+    elif(parser):
+        ast = parser.parse_file(src, deps)
+    else:
+        ast = fparse.parse_file(src, deps, callgraph=callgraph)
+    outdir = path.dirname(out)
+    if(not path.isdir(outdir)):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            if(not path.isdir(outdir)):
+                raise # not a race with another worker
+    write_atomic(out, fparse.format_ast(ast)+"\n")
+    if(depfile):
+        tmp = path.splitext(out)[0] + ".d.tmp." + socket.gethostname() + "." + str(os.getpid())
+        fparse.write_depfile(tmp, out, deps, src)
+        os.rename(tmp, path.splitext(out)[0] + ".d")
+    return(ast['name'])
+
+#===============================================================================
+class Profiler(object):
+    """Per-file profile of a run, the parser reports to it through its hook"""
+    def __init__(self):
+        self.records = []
+        self._record = None
+        self._t0 = None
+        if(not tracemalloc):
+            sys.stderr.write("Warning: tracemalloc not available, no peak memory recorded\n")
+
+    def start(self, src):
+        self._record = {'file':src, 'module':None, 'status':"failed", 'peak_memory':None,
+                        'buffer_size':None, 'fortran_lines':None, 'ast_nodes':None,
+                        'traced':bool(tracemalloc)} # the wall time is then inflated, several fold
+        if(tracemalloc):
+            tracemalloc.stop() # drops the traces of the previous file
+            tracemalloc.start()
+        self._t0 = time.time()
+
+    def __call__(self, filename, ast, stats):
+        self._record['buffer_size'] = stats['buffer_size']
+        self._record['fortran_lines'] = stats['fortran_lines']
+        self._record['ast_nodes'] = count_nodes(ast)
+
+    def stop(self, name):
+        rec = self._record
+        rec['wall_time'] = time.time() - self._t0
+        if(tracemalloc):
+            rec['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if(name is not None):
+            rec['module'], rec['status'] = name, "ok"
+        self.records.append(rec)
+        self._record = None
+
+    def ranked(self):
+        """Return the records, slowest first, with their time and memory ranks"""
+        by_memory = sorted(self.records, key=lambda r: -(r['peak_memory'] or 0))
+        for i, rec in enumerate(by_memory):
+            rec['memory_rank'] = i+1 if rec['peak_memory'] is not None else None
+        by_time = sorted(self.records, key=lambda r: -r['wall_time'])
+        for i, rec in enumerate(by_time):
+            rec['time_rank'] = i+1
+        return(by_time)
+
+    def write(self, fn):
+        records = self.ranked()
+        if(fn.endswith(".json")):
+            f = open(fn, "w")
+            json.dump([dict((k, r[k]) for k in PROFILE_FIELDS) for r in records], f, indent=1)
+            f.write("\n")
+        else:
+            f = open(fn, "w")
+            writer = csv.writer(f)
+            writer.writerow(PROFILE_FIELDS)
+            for r in records:
+                writer.writerow(["" if r[k] is None else r[k] for k in PROFILE_FIELDS])
+        f.close()
+
+    def summary(self, n=10):
+        """Print the n worst files by time and by memory"""
+        records = self.ranked()
+        print("Slowest files%s:" % (" (timed under tracemalloc)" if tracemalloc else ""))
+        for r in records[:n]:
+            print("  %8.3f s  %s" % (r['wall_time'], r['file']))
+        if(tracemalloc):
+            print("Heaviest files:")
+            for r in sorted(records, key=lambda r: r['memory_rank'])[:n]:
+                print("  %8.1f MB  %s" % (r['peak_memory']/1048576.0, r['file']))
+
+#===============================================================================
+def count_nodes(node):
+    """Return the number of nodes (dicts) of an AST"""
+    if(isinstance(node, dict)):
+        return(1 + sum(count_nodes(v) for v in node.values()))
+    if(isinstance(node, (list, tuple))):
+        return(sum(count_nodes(v) for v in node))
+    return(0)
+
+#===============================================================================
+def read_journal(fn):
+    """Return the journaled entries {source file: entry}, the latest ones win.
+       A line cut short by a crash is ignored."""
+    entries = {}
+    if(path.exists(fn)):
+        for line in open(fn):
+            try:
+                entry = literal_eval(line)
+            except (SyntaxError, ValueError):
+                continue
+            entries[entry['src']] = entry
+    return(entries)
+
+#===============================================================================
+def append_journal(journal, entry):
+    """Record a completed file, durably: once journaled it is never redone"""
+    journal.write(repr(entry)+"\n") # one entry per line
+    journal.flush()
+    os.fsync(journal.fileno())
+
+#===============================================================================
+def is_intact(entry, out):
+    """Tell whether a journaled file can be skipped: same output file, still
+       as it was written, and none of its inputs changed since"""
+    try:
+        if(entry['out'] != path.abspath(out) or file_hash(out) != entry['output']):
+            return(False)
+        if(entry['settings']['depfile'] and not path.exists(path.splitext(out)[0] + ".d")):
+            return(False)
+        return(all(file_hash(fn) == h for fn, h in entry['inputs'].items()))
+    except (IOError, OSError):
+        return(False) # missing file
+
+#===============================================================================
+def file_hash(fn):
+    f = open(fn, "rb")
+    h = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return(h)
+
+#===============================================================================
+def finish(queue, claim, dest, entry):
+    """Record the outcome of a claimed entry and release the claim"""
+    write_atomic(dest, pformat(entry)+"\n", path.join(queue, "tmp"))
+    try:
+        os.remove(claim)
+    except OSError:
+        pass # the claim was taken over meanwhile, the file will be parsed again
+
+#===============================================================================
+def reclaim_stale(queue, max_age):
+    """Move back to todo/ the claims of dead workers: processes that no longer
+       exist on this host, or claims that were not touched for max_age seconds"""
+    host = socket.gethostname()
+    now = time.time()
+    claimed_dir = path.join(queue, "claimed")
+    for claim in os.listdir(claimed_dir):
+        entry_id, claim_host, claim_pid = claim.rsplit("@", 2)
+        fn = path.join(claimed_dir, claim)
+        try:
+            stale = (now - os.stat(fn).st_mtime > max_age)
+            if(claim_host == host):
+                stale = stale or not pid_alive(int(claim_pid))
+            if(stale):
+                os.rename(fn, path.join(queue, "todo", entry_id))
+        except OSError:
+            pass # finished or reclaimed meanwhile
+
+#===============================================================================
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return(sys.exc_info()[1].errno == errno.EPERM)
+    return(True)
+
+#===============================================================================
+def merge(queue, fn_index, fn_archive=None, partial=False):
+    """Write the index {module name: .ast file, relative to the index} of the
+       parsed files, optionally the archive of all the ASTs too"""
+    pending = os.listdir(path.join(queue, "todo")) + os.listdir(path.join(queue, "claimed"))
+    failed = sorted(os.listdir(path.join(queue, "failed")))
+    for entry_id in failed:
+        print("Failed: %s" % read_entry(path.join(queue, "failed", entry_id))['src'])
+    if(pending and not partial):
+        print("Queue not drained yet: %d files pending" % len(pending))
+        return(False)
+
+    by_out = {} # a source enqueued again is done again: its latest entry wins
+    for entry_id in sorted(os.listdir(path.join(queue, "done"))):
+        entry = read_entry(path.join(queue, "done", entry_id))
+        by_out[entry['out']] = entry
+    index = {}
+    root = path.dirname(path.abspath(fn_index))
+    for out in sorted(by_out):
+        entry = by_out[out]
+        if(entry['module'] in index):
+            print('Error: module "%s" found in both %s and %s' % (entry['module'], path.join(root, index[entry['module']]), out))
+            return(False)
+        index[entry['module']] = path.relpath(out, root)
+    f = open(fn_index, "w")
+    f.write(fparse.format_ast(index) + "\n")
+    f.close()
+    print("Wrote: %s (%d modules)" % (fn_index, len(index)))
+
+    if(fn_archive):
+        write_archive(fn_archive, (read_ast(path.join(root, index[name])) for name in sorted(index)))
+        print("Wrote: "+fn_archive)
+    return(not failed)
+
+#===============================================================================
+def read_entry(fn):
+    f = open(fn)
+    entry = literal_eval(f.read())
+    f.close()
+    return(entry)
+
+#===============================================================================
+def write_atomic(fn, text, tmpdir=None):
+    """Write a file so that it never exists half written, even over NFS.
+       The temporary file is written in tmpdir (on the same file system),
+       by default next to fn."""
+    tmp = "%s.tmp.%s.%d" % (path.join(tmpdir or path.dirname(fn), path.basename(fn)), socket.gethostname(), os.getpid())
+    f = open(tmp, "w")
+    f.write(text)
+    f.close()
+    os.rename(tmp, fn)
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF
@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Differential equivalence harness for fparse.py
+
+Parses a corpus of Fortran files (real and/or synthetic ones) with a
+reference and a candidate parser, compares the resulting ASTs node by node
+and reports the throughput of both. A fast code path should be enabled by
+default only once it yields no differences over the whole corpus.
+
+The reference parser is by default the very same fparse.py, but it can be
+taken from any other file (e.g. an older revision extracted via
+"git show <rev>:fparse.py"). The keyword options given via --ref-opt/--opt
+are passed to the respective parse_file() calls. The keys added to the AST
+since the reference revision (e.g. the 'visibility' and 'privates' of the
+modules) can be left out of the comparison via --ignore-key. The
+candidate's ASTs are also serialized and read back (format_ast(),
+eval_ast()): they must come out the same, non-ASCII text included (the
+synthetic corpus has some).
+
+With --memory N, N synthetic modules are parsed instead by the batch driver
+(fparse_batch.py run) and the growth of the peak memory from a run over the
+first ones to a run over all of them is checked against a ceiling: it
+should not grow with the tree.
+
+With --scaling, pathological inputs (deep parentheses, long initializers,
+long doxygen blocks, many names sharing a \\param line, long continuations,
+routines without doxygen) are generated at growing sizes and the parse time
+is checked to grow roughly linearly: the exponent fitted between the
+smallest and the largest size must stay below --max-exponent, so that a
+quadratic path gets caught. Older revisions (--new) can be checked too."""
+
+import sys
+import os
+import math
+import time
+import shutil
+import tempfile
+from os import path
+from ast import literal_eval
+from optparse import OptionParser
+
+#===============================================================================
+def main():
+    parser = OptionParser(usage="fparse_bench.py [options] <file.F|dir> ...")
+    parser.add_option("--ref", metavar="FILE", default=None,
+                      help="reference parser module (default: fparse.py next to this script)")
+    parser.add_option("--new", metavar="FILE", default=None,
+                      help="candidate parser module (default: fparse.py next to this script)")
+    parser.add_option("--ref-opt", metavar="KEY=VALUE", action="append", default=[],
+                      help="keyword option for the reference parse_file()")
+    parser.add_option("--opt", metavar="KEY=VALUE", action="append", default=[],
+                      help="keyword option for the candidate parse_file()")
+    parser.add_option("--synthetic", metavar="N", type="int", default=0,
+                      help="add N synthetic modules to the corpus")
+    parser.add_option("--ignore-key", metavar="KEY", action="append", default=[],
+                      help="skip the AST key KEY when comparing (e.g. one the reference predates)")
+    parser.add_option("--max-diffs", metavar="N", type="int", default=10,
+                      help="max. number of differences reported per file")
+    parser.add_option("--memory", metavar="N", type="int", default=0,
+                      help="check the memory use of the batch driver over N synthetic modules")
+    parser.add_option("--max-growth", metavar="MB", type="float", default=8.0,
+                      help="ceiling for the growth of the peak memory (default: %default MB)")
+    parser.add_option("--scaling", action="store_true", default=False,
+                      help="check that the parse time of pathological inputs grows linearly")
+    parser.add_option("--max-exponent", metavar="X", type="float", default=1.4,
+                      help="ceiling for the fitted growth exponent (default: %default)")
+    options, args = parser.parse_args()
+
+    default = path.join(path.dirname(path.abspath(__file__)), "fparse.py")
+    if(options.scaling):
+        new = Implementation("new", options.new or default, {})
+        n_bad = check_scaling(new.module, args or sorted(SCALING_CASES), options.max_exponent)
+        sys.exit(1 if n_bad else 0)
+
+    if(options.memory):
+        growth = check_memory(options.memory)
+        print("Peak memory growth over %d modules: %.1f MB (ceiling: %.1f MB)"
+              % (options.memory, growth, options.max_growth))
+        sys.exit(1 if growth > options.max_growth else 0)
+
+    ref = Implementation("ref", options.ref or default, parse_opts(options.ref_opt))
+    new = Implementation("new", options.new or default, parse_opts(options.opt))
+
+    tmpdir = None
+    files = find_sources(args)
+    if(options.synthetic):
+        tmpdir = tempfile.mkdtemp(prefix="fparse_bench_")
+        files += write_synthetic_corpus(tmpdir, options.synthetic)
+    if(not files):
+        parser.print_usage()
+        sys.exit(1)
+
+    try:
+        n_differ = run_equivalence(files, ref, new, options.max_diffs, options.ignore_key)
+    finally:
+        if(tmpdir):
+            shutil.rmtree(tmpdir)
+
+    sys.exit(1 if n_differ else 0)
+
+#===============================================================================
+def parse_opts(opts):
+    """Convert a list of "key=value" strings into a keyword arguments dict"""
+    kwargs = {}
+    for o in opts:
+        k, v = o.split("=", 1)
+        try:
+            kwargs[k] = literal_eval(v)
+        except (ValueError, SyntaxError):
+            kwargs[k] = v  # plain string
+    return(kwargs)
+
+#===============================================================================
+def find_sources(args):
+    files = []
+    for a in args:
+        if(path.isdir(a)):
+            for root, dirs, fns in os.walk(a):
+                dirs.sort()
+                files.extend(path.join(root, fn) for fn in sorted(fns) if fn.endswith(".F"))
+        else:
+            files.append(a)
+    return(files)
+
+#===============================================================================
+class Implementation(object):
+    """A parser module along with the options its parse_file() is called with"""
+    def __init__(self, label, filename, kwargs):
+        self.label = label
+        self.filename = filename
+        self.kwargs = kwargs
+        self.module = load_source("fparse_"+label, filename)
+        self.elapsed = 0.0
+
+    def parse(self, fn):
+        """Return the AST of fn, or the raised exception"""
+        t0 = time.time()
+        try:
+            ast = self.module.parse_file(fn, **self.kwargs)
+        except Exception:
+            ast = sys.exc_info()[1]
+        self.elapsed += time.time() - t0
+        return(ast)
+
+    def describe(self):
+        opts = ", ".join("%s=%r" % kv for kv in sorted(self.kwargs.items()))
+        return("%s [%s]" % (self.filename, opts))
+
+#===============================================================================
+def load_source(name, filename):
+    """Import a module from a file under the given name (imp is gone in Python 3.12)"""
+    try:
+        import importlib.util
+    except ImportError:
+        import imp  # Python 2
+        return(imp.load_source(name, filename))
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module  # as imp did, e.g. for multiprocessing's pickles
+    spec.loader.exec_module(module)
+    return(module)
+
+#===============================================================================
+def run_equivalence(files, ref, new, max_diffs=10, ignore=()):
+    """Parse files with both implementations, print differences (but in the
+       keys to ignore) and throughput, return the number of files whose ASTs
+       differ"""
+    print("ref: " + ref.describe())
+    print("new: " + new.describe())
+
+    n_lines, n_differ, n_failed = 0, 0, 0
+    for fn in files:
+        n_lines += count_lines(fn)
+        ast_ref, ast_new = ref.parse(fn), new.parse(fn)
+        ref_failed, new_failed = isinstance(ast_ref, Exception), isinstance(ast_new, Exception)
+        if(ref_failed and new_failed):
+            n_failed += 1
+            continue
+        if(ref_failed or new_failed):
+            diffs = [("", describe_node(ast_ref), describe_node(ast_new))]
+        else:
+            diffs = list(diff_ast(ast_ref, ast_new, ignore=ignore))
+        if(not new_failed and hasattr(new.module, "eval_ast")):
+            text = new.module.format_ast(ast_new)
+            diffs += list(diff_ast(ast_new, new.module.eval_ast(text), "<serialized>"))
+        if(diffs):
+            n_differ += 1
+            print("DIFFER: %s (%d differences)" % (fn, len(diffs)))
+            for where, a, b in diffs[:max_diffs]:
+                print("  at %s:\n    ref: %s\n    new: %s" % (where or "<root>", a, b))
+
+    print("Files: %d, identical: %d, differ: %d, failed with both: %d"
+          % (len(files), len(files)-n_differ-n_failed, n_differ, n_failed))
+    for impl in (ref, new):
+        print(throughput(impl, len(files), n_lines))
+    return(n_differ)
+
+#===============================================================================
+def throughput(impl, n_files, n_lines):
+    t = max(impl.elapsed, 1e-9)
+    return("%s: %8.3f s  %8.1f files/s  %10.1f lines/s" % (impl.label, t, n_files/t, n_lines/t))
+
+#===============================================================================
+def count_lines(fn):
+    f = open(fn, "rb")
+    n = f.read().count(b"\n")
+    f.close()
+    return(n)
+
+#===============================================================================
+def describe_node(node):
+    if(isinstance(node, Exception)):
+        return("raised %s" % node.__class__.__name__)
+    text = repr(node)
+    return(text if len(text) < 200 else text[:197] + "...")
+
+#===============================================================================
+def diff_ast(a, b, where="", ignore=()):
+    """Walk two ASTs in parallel, yield a (location, node_a, node_b) tuple for
+       each node that differs, the dict keys to ignore aside"""
+    if(type(a) != type(b)):
+        yield (where, describe_node(a), describe_node(b))
+    elif(isinstance(a, dict)):
+        for k in sorted((set(a) | set(b)) - set(ignore)):
+            sub = "%s[%r]" % (where, k)
+            if(not k in a or not k in b):
+                yield (sub, describe_node(a.get(k, "<missing>")), describe_node(b.get(k, "<missing>")))
+            else:
+                for d in diff_ast(a[k], b[k], sub, ignore):
+                    yield d
+    elif(isinstance(a, (list, tuple))):
+        if(len(a) != len(b)):
+            yield (where+".len", len(a), len(b))
+        for i, (aa, bb) in enumerate(zip(a, b)):
+            for d in diff_ast(aa, bb, "%s[%d]" % (where, i), ignore):
+                yield d
+    elif(a != b):
+        yield (where, describe_node(a), describe_node(b))
+
+#===============================================================================
+def check_memory(n_modules, n_warmup=50):
+    """Parse synthetic modules with the batch driver (fparse_batch.py run,
+       with its default options: a shared Parser, the journal and index),
+       return how much the peak resident memory (in MB) grew from a run over
+       the first n_warmup modules to a run over all of them"""
+    import fparse_batch
+    options = fparse_batch.option_parser().get_default_values()
+    tmpdir = tempfile.mkdtemp(prefix="fparse_bench_")
+    srcdir, outdir = path.join(tmpdir, "src"), path.join(tmpdir, "out")
+    options.index = path.join(tmpdir, "index")
+    os.makedirs(srcdir)
+    try:
+        n_warmup = min(n_warmup, n_modules-1)
+        for i in range(n_modules):
+            if(i == n_warmup):
+                fparse_batch.run(outdir, [srcdir], options)
+                peak0 = peak_memory()
+            f = open(path.join(srcdir, "synth_mod_%05d.F" % i), "w")
+            f.write(synthetic_module("synth_mod_%05d" % i))
+            f.close()
+        fparse_batch.run(outdir, [srcdir], options)
+    finally:
+        shutil.rmtree(tmpdir)
+    return(peak_memory() - peak0)
+
+#===============================================================================
+def check_scaling(fparse, cases, max_exponent, factors=(1, 2, 4, 8), repeat=3):
+    """Time the parsing (by the given fparse module, preprocessing excluded)
+       of each pathological case at growing sizes, return the number of
+       cases growing faster than t ~ size**max_exponent. Older revisions
+       without a Parser are timed through parse_file(), cpp included."""
+    tmpdir = tempfile.mkdtemp(prefix="fparse_bench_")
+    if(hasattr(fparse, "Parser")):
+        parse = fparse.Parser(cache_size=0).parse_string
+    else:
+        parse = fparse.parse_file
+    n_bad = 0
+    try:
+        for name in cases:
+            generate, base = SCALING_CASES[name]
+            times = []
+            for f in factors:
+                size = base * f
+                fn = path.join(tmpdir, "%s_%d.F" % (name, size))
+                if(hasattr(fparse, "Parser")):
+                    arg = fparse.preprocess(fn, generate(size))
+                else:
+                    arg = fn
+                    out = open(fn, "w")
+                    out.write(generate(size))
+                    out.close()
+                best = None
+                for i in range(repeat):
+                    t0 = time.time()
+                    parse(arg)
+                    t = time.time() - t0
+                    best = t if best is None else min(best, t)
+                times.append(best)
+            exponent = math.log(max(times[-1], 1e-9)/max(times[0], 1e-9)) / math.log(factors[-1]/float(factors[0]))
+            ok = exponent <= max_exponent
+            n_bad += not ok
+            print("%-16s %s  exponent: %5.2f  %s" % (name, "  ".join("%8.4f s" % t for t in times),
+                                                     exponent, "ok" if ok else "SUPERLINEAR"))
+    finally:
+        shutil.rmtree(tmpdir)
+    return(n_bad)
+
+# The generators return the source of a module whose pathological part has
+#   the given size, the number next to each is the smallest size checked.
+
+#===============================================================================
+def nested_parens_module(size):
+    """A kind selector nested size parentheses deep (get_var_type())"""
+    kind = "("*size + "8" + ")"*size
+    return("MODULE nested\n   REAL(KIND=%s), PUBLIC :: x\nEND MODULE nested\n" % kind)
+
+#===============================================================================
+def long_parameter_module(size):
+    """A PARAMETER array initialized with size values (get_next_variable())"""
+    values = ", ".join("%d" % i for i in range(size))
+    return("MODULE long_param\n   INTEGER, PARAMETER, DIMENSION(%d) :: table = (/ %s /)\nEND MODULE long_param\n"
+           % (size, values))
+
+#===============================================================================
+def long_doxygen_module(size):
+    """A routine whose doxygen block has a size lines long description (parse_doxyvar())"""
+    lines = ["MODULE long_doxy", "CONTAINS",
+             "!> \\brief a routine with a long description",
+             "!> \\param x the argument, described"]
+    lines += ["!>        at length, line %d of it" % i for i in range(size)]
+    lines += ["   SUBROUTINE r(x)", "      INTEGER :: x", "   END SUBROUTINE r", "END MODULE long_doxy", ""]
+    return("\n".join(lines))
+
+#===============================================================================
+def grouped_doxygen_module(size):
+    """A routine whose size arguments share a single \\param line (parse_doxyvar())"""
+    names = ", ".join("a%d" % i for i in range(size))
+    lines = ["MODULE grouped_doxy", "CONTAINS",
+             "!> \\brief a routine with many arguments",
+             "!> \\param %s the arguments" % names,
+             "   SUBROUTINE r(%s)" % names, "      INTEGER :: %s" % names,
+             "   END SUBROUTINE r", "END MODULE grouped_doxy", ""]
+    return("\n".join(lines))
+
+#===============================================================================
+def continuations_module(size):
+    """A declaration continued over size lines (next_fortran_line())"""
+    lines = ["MODULE cont", "   INTEGER, PUBLIC :: v0, &"]
+    lines += ["      v%d, & ! a comment" % i for i in range(1, size)]
+    lines += ["      v%d" % size, "END MODULE cont", ""]
+    return("\n".join(lines))
+
+#===============================================================================
+def no_doxygen_module(size):
+    """size routines without doxygen, after plain comments (parse_doxygen())"""
+    lines = ["MODULE no_doxy", "CONTAINS"]
+    for i in range(size):
+        lines += ["! plain comment", "! " + "-"*70,
+                  "   SUBROUTINE r%d(x)" % i, "      INTEGER :: x", "      x = %d" % i,
+                  "   END SUBROUTINE r%d" % i]
+    lines += ["END MODULE no_doxy", ""]
+    return("\n".join(lines))
+
+SCALING_CASES = {
+    'nested_parens':  (nested_parens_module, 2000),
+    'long_parameter': (long_parameter_module, 2000),
+    'long_doxygen':   (long_doxygen_module, 500),
+    'grouped_doxygen': (grouped_doxygen_module, 2000),
+    'continuations':  (continuations_module, 2000),
+    'no_doxygen':     (no_doxygen_module, 250),
+}
+
+#===============================================================================
+def peak_memory():
+    """Peak resident memory of the process so far, in MB"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(peak / (1024.0*1024.0) if sys.platform == "darwin" else peak / 1024.0)
+
+#===============================================================================
+def write_synthetic_corpus(dirname, n_modules, n_routines=20):
+    files = []
+    for i in range(n_modules):
+        fn = path.join(dirname, "synth_mod_%04d.F" % i)
+        f = open(fn, "w")
+        f.write(synthetic_module("synth_mod_%04d" % i, n_routines))
+        f.close()
+        files.append(fn)
+    fn = path.join(dirname, "synth_non_ascii.F")
+    f = open(fn, "wb")
+    f.write(non_ascii_module())
+    f.close()
+    files.append(fn)
+    return(files)
+
+#===============================================================================
+def synthetic_module(name, n_routines=20, n_args=4):
+    """Return the source of a CP2K-like module exercising most of the syntax
+       the parser understands: doxygen blocks, derived types, interfaces,
+       continuation lines, quoted strings, nested routines, ..."""
+    out = []
+    w = out.append
+    w("! " + "*"*98)
+    w("!> \\brief synthetic module %s" % name)
+    w("!> \\author fparse_bench.py")
+    w("! " + "*"*98)
+    w("MODULE %s" % name)
+    w("   USE kinds,                           ONLY: dp, &")
+    w("                                              int_8")
+    w("   USE other_types,                     ONLY: other_type, rename => other_release")
+    w("   IMPLICIT NONE")
+    w("   PRIVATE")
+    w("")
+    w("   CHARACTER(len=*), PARAMETER, PRIVATE :: moduleN = '%s'" % name)
+    w("   INTEGER, PARAMETER, DIMENSION(6) :: table = (/ 1, 2, 3, &")
+    w("                                               ! a comment in between")
+    w("                                               4, 5, 6 /)")
+    w("   LOGICAL, SAVE :: flag = .FALSE.")
+    w("")
+    w("   PUBLIC :: %s_type" % name)
+    w("   !API")
+    w("   PUBLIC :: %s" % ", ".join("%s_r%d" % (name, r) for r in range(n_routines)))
+    w("")
+    w("   INTERFACE %s_generic" % name)
+    w("      MODULE PROCEDURE %s_r0, %s_r1" % (name, name))
+    w("   END INTERFACE")
+    w("")
+    w("! " + "*"*98)
+    w("!> \\brief a derived type")
+    w("!> \\param n the size")
+    w("!> \\param a, b grouped members")
+    w("! " + "*"*98)
+    w("   TYPE %s_type" % name)
+    w("      INTEGER :: n = 0")
+    w("      REAL(KIND=dp), DIMENSION(:, :), POINTER :: a => NULL(), b => NULL()")
+    w("      TYPE(other_type), POINTER :: other")
+    w("   END TYPE %s_type" % name)
+    w("")
+    w("CONTAINS")
+    for r in range(n_routines):
+        rname = "%s_r%d" % (name, r)
+        args = ["arg%d" % a for a in range(n_args)]
+        is_func = (r % 3 == 2)
+        w("")
+        w("! " + "*"*98)
+        w("!> \\brief routine number %d of %s, with a description" % (r, name))
+        w("!>        spanning two lines")
+        w("!> \\param arg0 [in] the first argument")
+        w("!> \\param arg1 (optional) an optional one")
+        w("!> \\param arg2, arg3 grouped arguments")
+        if(is_func):
+            w("!> \\return the result")
+        w("! " + "*"*98)
+        if(is_func):
+            w("   FUNCTION %s(%s) RESULT(res)" % (rname, ", ".join(args)))
+        else:
+            w("   RECURSIVE SUBROUTINE %s(%s, &" % (rname, ", ".join(args[:2])))
+            w("                          %s)" % ", ".join(args[2:]))
+        w("      TYPE(%s_type), INTENT(INOUT) :: arg0" % name)
+        w("      INTEGER, INTENT(IN), OPTIONAL :: arg1")
+        w("      REAL(KIND=dp), DIMENSION(:), INTENT(OUT) :: arg2, arg3")
+        for a in args[4:]:
+            w("      INTEGER :: %s" % a)
+        if(is_func):
+            w("      REAL(KIND=dp) :: res")
+        w("")
+        w("      CHARACTER(len=*), PARAMETER :: routineN = '%s'" % rname)
+        w("      INTEGER :: handle, i")
+        w("")
+        w("      CALL timeset(routineN, handle); i = 0")
+        w("      arg2(:) = 1.0_dp ! a trailing comment; with a semicolon")
+        w("      CALL helper_%d(arg0, &" % r)
+        w("                    ! comment within a continued call")
+        w("                    arg2)")
+        w("      WRITE (*, '(A)') \"a string with ! and ; inside\"")
+        if(is_func):
+            w("      res = SUM(arg2) + ext_func(arg3)")
+        w("      CALL timestop(handle)")
+        w("   CONTAINS")
+        w("      SUBROUTINE helper_%d(x, y)" % r)
+        w("         TYPE(%s_type) :: x" % name)
+        w("         REAL(KIND=dp), DIMENSION(:) :: y")
+        w("         y = x%n")
+        w("      END SUBROUTINE helper_%d" % r)
+        if(is_func):
+            w("   END FUNCTION %s" % rname)
+        else:
+            w("   END SUBROUTINE %s" % rname)
+    w("")
+    w("END MODULE %s" % name)
+    w("")
+    return("\n".join(out))
+
+#===============================================================================
+def non_ascii_module():
+    """Return the bytes of a synthetic module whose doxygen text is partly
+       UTF-8 and partly Latin-1, i.e. not decodable as UTF-8"""
+    text = synthetic_module("synth_non_ascii", n_routines=3).encode("ascii")
+    text = text.replace(b"synthetic module", u"synthetic m\u00f6dule".encode("utf-8"), 1)
+    return(text.replace(b"with a description", u"with a caf\u00e9 description".encode("latin-1")))
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF
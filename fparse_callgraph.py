@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Export the call graph of a whole tree as an adjacency list
+
+The input are the .ast files written by "fparse.py --callgraph". Callers are
+qualified as MODULE.ROUTINE, callees are qualified the same way whenever
+they can be told apart: defined in the caller's module or uniquely defined
+in the tree. The candidate function references recorded by the parser are
+kept only if they name a function (or a generic interface) of the tree."""
+
+import sys
+
+from fparse import format_ast, eval_ast
+
+#===============================================================================
+def main():
+    if(len(sys.argv) < 3):
+        print("Usage: fparse_callgraph.py <output.callgraph> <input.ast> ...")
+        sys.exit(1)
+
+    fn_out, fn_asts = sys.argv[1], sys.argv[2:]
+    asts = [read_ast(fn) for fn in fn_asts]
+    graph = get_callgraph(asts)
+    f = open(fn_out, "w")
+    f.write(format_ast(graph) + "\n")
+    f.close()
+
+    print("Wrote: "+fn_out)
+
+#===============================================================================
+def read_ast(fn):
+    f = open(fn)
+    ast = eval_ast(f.read())
+    f.close()
+    return(ast)
+
+#===============================================================================
+def get_callgraph(asts):
+    """Return a dict mapping each routine to the sorted list of its callees"""
+    # index of the routines defined in the tree: name -> defining modules
+    defined = {}
+    functions = set()
+    for mod in asts:
+        for r in mod['subroutines'] + mod['functions']:
+            defined.setdefault(r['name'], []).append(mod['name'])
+        functions.update(f['name'] for f in mod['functions'])
+        functions.update(i['name'] for i in mod['interfaces'] if i['name'])
+
+    def qualify(name, modname):
+        where = defined.get(name, [])
+        if(modname in where):
+            return(modname + "." + name)
+        if(len(where) == 1):
+            return(where[0] + "." + name)
+        return(name)  # external, intrinsic or ambiguous
+
+    graph = {}
+    for mod in asts:
+        for r in mod['subroutines'] + mod['functions']:
+            assert('calls' in r) # was the tree parsed with --callgraph?
+            callees = set(r['calls'])
+            callees.update(n for n in r['func_refs'] if n in functions)
+            graph[mod['name'] + "." + r['name']] = sorted(qualify(n, mod['name']) for n in callees)
+    return(graph)
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF
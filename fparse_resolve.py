@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Resolve the TYPE(...) references of a whole tree to their defining module
+
+The input are the .ast files written by fparse.py. Each argument, variable,
+return value and type component declared as TYPE(X) or CLASS(X) gets a
+'type_module' key: the name of the module defining the derived type X, or
+None if it is not defined within the tree (e.g. an external library).
+
+A name is looked up in the scope of the reference (the routine's own types
+and USE statements, then the module's), following USE statements from
+module to module and the renames of USE ... ONLY lists. A USE sees only the
+public names of a module: its PUBLIC list, or with a public default anything
+but its PRIVATE list. Every (module, name) lookup is memoized, so the whole
+tree is resolved in one linear pass."""
+
+import re
+import sys
+from os import path
+
+from fparse import format_ast, eval_ast
+
+TYPE_REF_REGEX = re.compile(r"(?:TYPE|CLASS)\((\w+)\)")
+
+#===============================================================================
+def main():
+    if(len(sys.argv) < 3):
+        print("Usage: fparse_resolve.py <outdir> <input.ast> ...")
+        sys.exit(1)
+
+    outdir, fn_asts = sys.argv[1], sys.argv[2:]
+    asts = [read_ast(fn) for fn in fn_asts]
+    n_refs, n_unresolved = resolve_types(asts)
+    for fn, ast in zip(fn_asts, asts):
+        fn_out = path.join(outdir, path.basename(fn))
+        f = open(fn_out, "w")
+        f.write(format_ast(ast)+"\n")
+        f.close()
+    print("Resolved: %d references, %d outside the tree" % (n_refs, n_unresolved))
+    print("Wrote: %d files into %s" % (len(asts), outdir))
+
+#===============================================================================
+def read_ast(fn):
+    f = open(fn)
+    ast = eval_ast(f.read())
+    f.close()
+    return(ast)
+
+#===============================================================================
+def resolve_types(asts):
+    """Annotate in place the TYPE(...) references of the module ASTs,
+       return the number of references and of unresolved ones"""
+    modules = dict((mod['name'], mod) for mod in asts)
+    defined = {} # module name -> {type name: module name} of its own types
+    exports = {} # module name -> (explicit publics, explicit privates, public by default)
+    for mod in asts:
+        defined[mod['name']] = dict((t['name'], mod['name']) for t in mod['types'])
+        exports[mod['name']] = (set(p['name'] for p in mod['publics']),
+                                set(p['name'] for p in mod.get('privates', [])),
+                                mod.get('visibility', 'PUBLIC') == 'PUBLIC')
+
+    def is_exported(modname, name):
+        """Tell whether name, defined in or used by module modname, is public"""
+        publics, privates, default_public = exports[modname]
+        return(name in publics or (default_public and not name in privates))
+
+    memo = {}
+    def lookup(modname, name):
+        """Return the module defining type name, as seen from module modname"""
+        key = (modname, name)
+        if(not key in memo):
+            memo[key] = None # guards against (invalid) circular USEs
+            if(modname in modules):
+                memo[key] = defined[modname].get(name) or lookup_uses(modules[modname]['uses'], name)
+        return(memo[key])
+
+    def lookup_exported(modname, name):
+        """Return the module defining type name, as seen through USE modname"""
+        if(modname in modules and is_exported(modname, name)):
+            return(lookup(modname, name))
+        return(None)
+
+    def lookup_uses(uses, name):
+        for u in uses:
+            if('only' in u):
+                if(name in u['only']):
+                    return(lookup_exported(u['from'], u['only'][name])) # local=>remote rename
+            else:
+                found = lookup_exported(u['from'], name)
+                if(found):
+                    return(found)
+        return(None)
+
+    counts = [0, 0]
+    def annotate(decls, scope):
+        for d in decls:
+            m = TYPE_REF_REGEX.match(d['type'])
+            if(m):
+                d['type_module'] = scope(m.group(1))
+                counts[0] += 1
+                counts[1] += d['type_module'] is None
+
+    for mod in asts:
+        modname = mod['name']
+        scope = lambda name: lookup(modname, name)
+        annotate(mod['variables'], scope)
+        for t in mod['types']:
+            annotate(t['variables'], scope)
+        routines = mod['subroutines'] + mod['functions']
+        for i in mod['interfaces']:
+            routines += [p for p in i['procedures'] if isinstance(p, dict)]
+        for r in routines:
+            local = dict((t['name'], modname) for t in r['types'])
+            def routine_scope(name):
+                return(local.get(name) or lookup_uses(r['uses'], name) or lookup(modname, name))
+            annotate(r['args'], routine_scope)
+            for t in r['types']:
+                annotate(t['variables'], routine_scope)
+            if(r.get('retval') and 'type' in r['retval']):
+                annotate([r['retval']], routine_scope)
+    return(tuple(counts))
+
+#===============================================================================
+if __name__ == '__main__':
+    main()
+
+#EOF